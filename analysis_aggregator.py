@@ -0,0 +1,79 @@
+import threading
+import time
+from typing import Callable, Dict, List
+
+# Per-session buffer of user messages awaiting proficiency analysis. A session's
+# messages are handed to flush_fn together once it has max_messages buffered, its
+# oldest message is max_wait seconds old, or it has been idle for idle_after
+# seconds - so one LLM call covers several turns instead of one call per turn.
+
+
+class AnalysisAggregator:
+    def __init__(self, flush_fn: Callable[[str, List[str], str], None], max_messages: int = 5,
+                 max_wait: float = 30.0, idle_after: float = 10.0, tick: float = 1.0):
+        self.flush_fn = flush_fn
+        self.max_messages = max_messages
+        self.max_wait = max_wait
+        self.idle_after = idle_after
+        self.tick = tick
+        self._buffers: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self.messages_added = 0
+        self.batches_flushed = 0
+        self.messages_flushed = 0
+        self._sweeper = threading.Thread(target=self._sweep, name="analysis-aggregator", daemon=True)
+        self._sweeper.start()
+
+    def add(self, session_id: str, message: str, target_lang: str = "en"):
+        ready = []
+        with self._lock:
+            buf = self._buffers.get(session_id)
+            if buf and buf["lang"] != target_lang:
+                # Don't mix languages in one analysis
+                ready.append((session_id, self._buffers.pop(session_id)))
+                buf = None
+            now = time.time()
+            if buf is None:
+                buf = self._buffers[session_id] = {"lang": target_lang, "messages": [], "first": now, "last": now}
+            buf["messages"].append(message)
+            buf["last"] = now
+            self.messages_added += 1
+            if len(buf["messages"]) >= self.max_messages:
+                ready.append((session_id, self._buffers.pop(session_id)))
+        self._flush(ready)
+
+    def _flush(self, ready):
+        for session_id, buf in ready:
+            self.batches_flushed += 1
+            self.messages_flushed += len(buf["messages"])
+            try:
+                self.flush_fn(session_id, buf["messages"], buf["lang"])
+            except Exception as e:
+                print(f"[Analysis] flush failed for session {session_id}:", e)
+
+    def _sweep(self):
+        while True:
+            time.sleep(self.tick)
+            now = time.time()
+            with self._lock:
+                due = [
+                    sid for sid, buf in self._buffers.items()
+                    if now - buf["first"] >= self.max_wait or now - buf["last"] >= self.idle_after
+                ]
+                ready = [(sid, self._buffers.pop(sid)) for sid in due]
+            self._flush(ready)
+
+    def flush_all(self):
+        with self._lock:
+            ready = list(self._buffers.items())
+            self._buffers.clear()
+        self._flush(ready)
+
+    def stats(self) -> dict:
+        return {
+            "sessions_buffered": len(self._buffers),
+            "messages_added": self.messages_added,
+            "batches_flushed": self.batches_flushed,
+            "messages_flushed": self.messages_flushed,
+            "avg_batch_size": round(self.messages_flushed / self.batches_flushed, 2) if self.batches_flushed else None,
+        }
@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+import uuid
+from typing import Optional
+
+from cache import LRUCache
+
+# Size-bounded on-disk storage for generated audio. Files keep their flat public
+# names (e.g. "<sha256>.mp3") but live in shard directories keyed by the first two
+# characters, writes land atomically via temp file + rename, and a background
+# sweeper evicts the least recently accessed files once the byte budget is exceeded.
+# Last access is the file mtime (bumped on reads, throttled), so several worker
+# processes sharing one directory agree on what is cold.
+
+TMP_DIR = ".tmp"
+
+
+class AudioStore:
+    def __init__(self, root: str, max_bytes: int = 1024 * 1024 * 1024, sweep_interval: float = 60.0,
+                 min_age: float = 300.0, touch_interval: float = 60.0, low_watermark: float = 0.9):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.min_age = min_age  # files accessed more recently than this are never evicted
+        self.low_watermark = low_watermark  # evict down to this fraction of max_bytes
+        self._touched = LRUCache(maxsize=10000, ttl=touch_interval)
+        os.makedirs(os.path.join(root, TMP_DIR), exist_ok=True)
+        self.bytes = 0
+        self.files = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.sweeps = 0
+        self.last_sweep_ms: Optional[float] = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._worker = threading.Thread(target=self._run, name="audio-store", daemon=True)
+        self._worker.start()
+
+    def path(self, fname: str) -> Optional[str]:
+        """Sharded location of fname, or None for names that are not plain file names"""
+        if not fname or fname != os.path.basename(fname) or fname.startswith("."):
+            return None
+        return os.path.join(self.root, fname[:2], fname)
+
+    def exists(self, fname: str) -> bool:
+        path = self.path(fname)
+        return path is not None and os.path.exists(path)
+
+    def tmp_path(self) -> str:
+        return os.path.join(self.root, TMP_DIR, uuid.uuid4().hex)
+
+    def commit(self, tmp: str, fname: str):
+        """Atomically move a finished temp file into place: readers never see a partial file"""
+        path = self.path(fname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)
+        with self._lock:
+            self.bytes += size
+            self.files += 1
+            over = self.bytes > self.max_bytes
+        if over:
+            self._wake.set()
+
+    def touch(self, fname: str):
+        """Record an access (mtime), at most once per touch_interval per file"""
+        if self._touched.get(fname) is not None:
+            return
+        self._touched.put(fname, True)
+        try:
+            os.utime(self.path(fname))
+        except (OSError, TypeError):
+            pass
+
+    def sweep(self):
+        """Re-measure usage and evict least recently accessed files down to the low watermark"""
+        started = time.time()
+        entries = []
+        for shard in list(os.scandir(self.root)):
+            if shard.is_file():
+                self._migrate(shard)  # file from the old flat layout
+        for shard in os.scandir(self.root):
+            if shard.name == TMP_DIR:
+                self._clean_tmp(shard.path, started)
+            elif shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        total, files = sum(size for _, size, _ in entries), len(entries)
+        if total > self.max_bytes:
+            target = self.max_bytes * self.low_watermark
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= target or started - mtime < self.min_age:
+                    break
+                try:
+                    os.remove(path)  # a client mid-download keeps its open handle on POSIX
+                except FileNotFoundError:
+                    pass
+                total -= size
+                files -= 1
+                self.evictions += 1
+                self.evicted_bytes += size
+        with self._lock:
+            self.bytes = total
+            self.files = files
+        self.sweeps += 1
+        self.last_sweep_ms = round((time.time() - started) * 1000, 1)
+
+    def _migrate(self, entry: os.DirEntry):
+        path = self.path(entry.name)
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.replace(entry.path, path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _clean_tmp(tmp_dir: str, now: float):
+        # Leftovers from a crash mid-synthesis
+        for entry in os.scandir(tmp_dir):
+            try:
+                if now - entry.stat().st_mtime > 3600:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                print("Audio store sweep error:", e)
+            self._wake.wait(self.sweep_interval)
+            self._wake.clear()
+
+    def close(self):
+        self._closed.set()
+        self._wake.set()
+        self._worker.join(timeout=5.0)
+
+    def stats(self) -> dict:
+        return {
+            "bytes": self.bytes,
+            "files": self.files,
+            "max_bytes": self.max_bytes,
+            "usage": round(self.bytes / self.max_bytes, 4) if self.max_bytes else None,
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+            "sweeps": self.sweeps,
+            "last_sweep_ms": self.last_sweep_ms,
+        }
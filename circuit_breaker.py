@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Optional
+
+# Failure-rate circuit breaker for upstream calls. While an upstream is failing,
+# callers skip it immediately instead of each paying a slow failure.
+#
+# closed:    calls pass; the outcome of the last `window` calls is recorded.
+# open:      entered when at least min_calls outcomes are recorded and the failure
+#            fraction reaches failure_rate; calls are rejected for `cooldown` seconds.
+# half_open: after the cooldown one trial call is let through (then another after
+#            each further cooldown); its success closes the breaker, a failure re-opens it.
+#            Outcomes of calls admitted before the breaker opened don't close it.
+# The trial is recognised by thread: a call's outcome is recorded on the thread that
+# was admitted by allow().
+
+
+class CircuitOpenError(Exception):
+    """Raised by CircuitBreaker.call when the breaker rejects the call"""
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_rate: float = 0.5, window: int = 20,
+                 min_calls: int = 5, cooldown: float = 30.0):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self._outcomes: Deque[bool] = deque(maxlen=window)  # True = failure
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._admitted = threading.local()  # .trial: this thread's current call is the half-open trial
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if time.time() - self._opened_at >= self.cooldown else "open"
+
+    def available(self) -> bool:
+        """Whether a call would be attempted right now (no side effects; use to skip optional work)"""
+        return self.state != "open"
+
+    def allow(self) -> bool:
+        """True if a call may go ahead now"""
+        with self._lock:
+            if self._opened_at is None:
+                self._admitted.trial = False
+                return True
+            now = time.time()
+            if now - self._opened_at >= self.cooldown:
+                self._opened_at = now  # one trial per cooldown, even if its outcome never comes back
+                self._admitted.trial = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        trial, self._admitted.trial = getattr(self._admitted, "trial", False), False
+        with self._lock:
+            self.calls += 1
+            if self._opened_at is not None:
+                if not trial:
+                    return  # a slow call from before the breaker opened says nothing about now
+                self._opened_at = None
+                self._outcomes.clear()
+            self._outcomes.append(False)
+
+    def record_failure(self):
+        self._admitted.trial = False
+        with self._lock:
+            self.calls += 1
+            self.failures += 1
+            self._outcomes.append(True)
+            if self._opened_at is not None:
+                self._opened_at = time.time()  # failed trial: stay open for another cooldown
+            elif len(self._outcomes) >= self.min_calls and self._rate() >= self.failure_rate:
+                self._opened_at = time.time()
+                self.trips += 1
+                print(f"Circuit {self.name} opened")
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """fn(*args, **kwargs) through the breaker; raises CircuitOpenError when open"""
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} circuit open")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def _rate(self) -> float:
+        return sum(self._outcomes) / len(self._outcomes) if self._outcomes else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "recent_failure_rate": round(self._rate(), 4),
+            "calls": self.calls,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "trips": self.trips,
+        }
+
+
+def breaker_from_env(name: str, prefix: str = "BREAKER") -> CircuitBreaker:
+    """Breaker configured from <prefix>_FAILURE_RATE / _WINDOW / _MIN_CALLS / _COOLDOWN"""
+    return CircuitBreaker(
+        name,
+        failure_rate=float(os.getenv(f"{prefix}_FAILURE_RATE", "0.5")),
+        window=int(os.getenv(f"{prefix}_WINDOW", "20")),
+        min_calls=int(os.getenv(f"{prefix}_MIN_CALLS", "5")),
+        cooldown=float(os.getenv(f"{prefix}_COOLDOWN", "30")),
+    )
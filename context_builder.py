@@ -0,0 +1,131 @@
+import hashlib
+import threading
+from functools import lru_cache
+from typing import Callable, List, Optional
+
+from cache import LRUCache
+
+# Token-budgeted prompt builder. The last keep_turns turns go in verbatim; older
+# turns are folded into a rolling per-session summary that is refreshed in the
+# background, so a long practice session sends about as many prompt tokens as a
+# short one.
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:  # optional dependency (or offline): fall back to an estimate
+    _encoding = None
+
+MESSAGE_OVERHEAD = 4  # role/separator tokens per chat message
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return max(1, len(text) // 4)
+
+
+def message_tokens(messages: List[dict]) -> int:
+    return sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+
+
+def _fingerprint(message: dict) -> str:
+    return hashlib.sha1(f"{message['role']}:{message['content']}".encode("utf-8")).hexdigest()
+
+
+class ContextBuilder:
+    def __init__(self, summarize: Callable[[str, List[dict]], str], submit: Callable[..., object],
+                 token_budget: int = 1500, keep_turns: int = 6, max_sessions: int = 5000):
+        self.summarize = summarize  # (previous_summary, new_messages) -> summary
+        self.submit = submit  # runs a background callable
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+        # session_id -> {"summary": str, "last": fingerprint of the last folded message}
+        self.summaries = LRUCache(maxsize=max_sessions)
+        self._updating = set()
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.full_tokens = 0
+        self.sent_tokens = 0
+        self.summary_updates = 0
+
+    def build(self, session_id: str, history: List[dict], extra: Optional[List[dict]] = None) -> dict:
+        """Fit history (+ extra system hints) into the budget; returns messages and token counts"""
+        extra = extra or []
+        system = [m for m in history if m["role"] == "system"]
+        turns = [m for m in history if m["role"] != "system"]
+        recent, older = turns[-self.keep_turns:], turns[:-self.keep_turns]
+
+        state = self.summaries.get(session_id)
+        unfolded = self._unfolded(older, state)
+        if unfolded:
+            self._schedule_update(session_id, state, unfolded)
+
+        context = []
+        if state and state["summary"]:
+            context.append({"role": "system", "content": f"Summary of the earlier conversation: {state['summary']}"})
+        budget = self.token_budget - message_tokens(system + context + extra)
+        # Until the summary catches up, keep as many not-yet-folded turns as still fit
+        available = budget - message_tokens(recent)
+        for m in reversed(unfolded):
+            cost = message_tokens([m])
+            if cost > available:
+                break
+            recent.insert(0, m)
+            available -= cost
+        # Over budget even so: drop the oldest verbatim turns, but always keep the latest one
+        while len(recent) > 1 and message_tokens(recent) > budget:
+            recent.pop(0)
+
+        messages = system + context + recent + extra
+        full = message_tokens(history + extra)
+        sent = message_tokens(messages)
+        self.turns += 1
+        self.full_tokens += full
+        self.sent_tokens += sent
+        return {"messages": messages, "prompt_tokens": sent, "saved_tokens": max(0, full - sent)}
+
+    @staticmethod
+    def _unfolded(older: List[dict], state: Optional[dict]) -> List[dict]:
+        if not older:
+            return []
+        if not state:
+            return older
+        fingerprints = [_fingerprint(m) for m in older]
+        if state["last"] in fingerprints:
+            # Everything up to the most recent match is already in the summary
+            last = len(fingerprints) - 1 - fingerprints[::-1].index(state["last"])
+            return older[last + 1:]
+        return older  # the last folded message has scrolled out of history
+
+    def _schedule_update(self, session_id: str, state: Optional[dict], unfolded: List[dict]):
+        with self._lock:
+            if session_id in self._updating:
+                return
+            self._updating.add(session_id)
+
+        def update():
+            try:
+                summary = self.summarize(state["summary"] if state else "", unfolded)
+                self.summaries.put(session_id, {"summary": summary, "last": _fingerprint(unfolded[-1])})
+                self.summary_updates += 1
+            finally:
+                with self._lock:
+                    self._updating.discard(session_id)
+
+        if not self.submit(update):
+            with self._lock:
+                self._updating.discard(session_id)
+
+    def stats(self) -> dict:
+        return {
+            "token_budget": self.token_budget,
+            "keep_turns": self.keep_turns,
+            "tokenizer": "tiktoken" if _encoding is not None else "estimate",
+            "turns": self.turns,
+            "summary_updates": self.summary_updates,
+            "avg_full_tokens": round(self.full_tokens / self.turns, 1) if self.turns else None,
+            "avg_prompt_tokens": round(self.sent_tokens / self.turns, 1) if self.turns else None,
+            "saved_tokens": self.full_tokens - self.sent_tokens,
+        }
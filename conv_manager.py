@@ -1,21 +1,195 @@
-from collections import defaultdict, deque
-from typing import Deque, Dict, List
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional
+
+from conv_store import ConversationStore, SQLiteConversationStore
+
+# In-memory conversation cache, bounded by session count, total bytes and idle time,
+# in front of a pluggable ConversationStore for durability.
+# session_id -> Session; the personalized system prompt is pinned outside the
+# turn deque so it is never pushed out by long conversations.
+
+
+class Session:
+    __slots__ = ("system", "system_meta", "turns", "last_access", "bytes", "version")
+
+    def __init__(self, max_history: int):
+        self.version: Optional[int] = None  # store version this copy reflects (shared stores)
+        self.system: Optional[str] = None
+        self.system_meta: Optional[str] = None  # what the pinned prompt was built from, set by the caller
+        self.turns: Deque[dict] = deque([], maxlen=max_history)
+        self.last_access = time.time()
+        self.bytes = 0
+
+    def messages(self) -> List[dict]:
+        history = [{"role": "system", "content": self.system}] if self.system is not None else []
+        return history + list(self.turns)
+
+
+def _size(content: str) -> int:
+    return len(content.encode("utf-8"))
+
 
-# Simple in-memory conversation store (not for production).
-# session_id -> deque of messages: {"role": "user"/"assistant"/"system", "content": "..."}
 class ConversationManager:
-    def __init__(self, max_history: int = 20):
+    def __init__(self, max_history: int = 20, max_sessions: int = 10000,
+                 max_bytes: int = 256 * 1024 * 1024, idle_ttl: float = 6 * 3600,
+                 store: Optional[ConversationStore] = None):
         self.max_history = max_history
-        self.sessions: Dict[str, Deque[dict]] = defaultdict(lambda: deque([], maxlen=self.max_history))
+        self.store = store or ConversationStore()
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        # Ordered by last access: least recently used first
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.total_bytes = 0
+        self.evictions = 0
+        self.coherence_reloads = 0
+        self._lock = threading.RLock()
+
+    def _resident(self, session_id: str) -> Optional[Session]:
+        """In-memory session, lazy-loading it from the store on first access"""
+        # Shared stores: another worker may have written since we cached this session
+        version = self.store.version(session_id) if self.store.shared else None
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is not None and (self._idle(session, time.time()) or session.version != version):
+                self._drop(session_id)
+                session = None
+                if version is not None:
+                    self.coherence_reloads += 1
+            if session is not None:
+                return session
+        loaded = self.store.load(session_id, self.max_history)  # outside the lock
+        if loaded is None:
+            return None
+        system, system_meta, turns = loaded
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = Session(self.max_history)
+                session.version = version
+                session.system = system
+                session.system_meta = system_meta
+                session.turns.extend(turns)
+                session.bytes = sum(_size(m["content"]) for m in session.turns) + (_size(system) if system else 0)
+                self.total_bytes += session.bytes
+                self._touch(session_id, session)
+                self._evict()
+            return session
 
-    def append(self, session_id: str, role: str, content: str):
-        self.sessions[session_id].append({"role": role, "content": content})
+    def append(self, session_id: str, role: str, content: str, meta: Optional[str] = None):
+        """Add a message; a system message replaces the pinned prompt, tagged with meta"""
+        before = self._resident(session_id)
+        expected = before.version if before is not None else (0 if self.store.shared else None)
+        version = self.store.append(session_id, role, content, meta)
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = Session(self.max_history)
+                session.version = expected
+            # If someone else wrote in between, leave the old version so the next read reloads
+            if version is not None and session.version is not None and version == session.version + 1:
+                session.version = version
+            if role == "system":
+                # Pinned: replaces any previous system prompt instead of using a turn slot
+                delta = _size(content) - (_size(session.system) if session.system is not None else 0)
+                session.system = content
+                session.system_meta = meta
+            else:
+                delta = _size(content)
+                if len(session.turns) == session.turns.maxlen:
+                    delta -= _size(session.turns[0]["content"])
+                session.turns.append({"role": role, "content": content})
+            session.bytes += delta
+            self.total_bytes += delta
+            self._touch(session_id, session)
+            self._evict()
 
     def get_history(self, session_id: str) -> List[dict]:
-        return list(self.sessions[session_id])
+        """Messages for a session ([] for unknown sessions - never allocates one)"""
+        if self._resident(session_id) is None:
+            return []
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return []
+            self._touch(session_id, session)
+            return session.messages()
+
+    def system_meta(self, session_id: str) -> Optional[str]:
+        """Tag stored with the pinned system prompt (None if there is none, or it was untagged)"""
+        session = self._resident(session_id)
+        return session.system_meta if session is not None else None
+
+    def lock(self, session_id: str):
+        """Context manager serializing a session's turns (across worker processes for shared stores)"""
+        return self.store.lock(session_id)
 
     def reset(self, session_id: str):
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        with self._lock:
+            if session_id in self.sessions:
+                self._drop(session_id)
+        self.store.delete(session_id)
+
+    def _touch(self, session_id: str, session: Session):
+        session.last_access = time.time()
+        self.sessions.move_to_end(session_id)
+
+    def _idle(self, session: Session, now: float) -> bool:
+        return bool(self.idle_ttl) and now - session.last_access > self.idle_ttl
+
+    def _drop(self, session_id: str):
+        session = self.sessions.pop(session_id)
+        self.total_bytes -= session.bytes
+
+    def _evict(self):
+        now = time.time()
+        while self.sessions:
+            oldest_id, oldest = next(iter(self.sessions.items()))
+            over = len(self.sessions) > self.max_sessions or self.total_bytes > self.max_bytes
+            if not over and not self._idle(oldest, now):
+                break
+            if len(self.sessions) == 1 and not self._idle(oldest, now):
+                break  # never evict the session being written
+            self._drop(oldest_id)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.sessions),
+            "bytes": self.total_bytes,
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "idle_ttl": self.idle_ttl,
+            "evictions": self.evictions,
+            "coherence_reloads": self.coherence_reloads,
+            "store": self.store.stats(),
+        }
+
+
+def _default_store() -> ConversationStore:
+    path = os.getenv("CONV_DB_PATH", os.path.join(os.path.dirname(__file__), "conversations.sqlite"))
+    if path.lower() in ("", "none", "memory"):
+        return ConversationStore()
+    try:
+        return SQLiteConversationStore(
+            path,
+            snapshot_interval=float(os.getenv("CONV_SNAPSHOT_INTERVAL", "300")),
+            # Shared mode keeps gunicorn workers coherent; turn off for a single-process dev server
+            shared=os.getenv("CONV_SHARED", "1") == "1",
+        )
+    except Exception as e:
+        print("Conversation store disabled:", e)
+        return ConversationStore()
+
 
-conv_manager = ConversationManager()
+conv_manager = ConversationManager(
+    max_sessions=int(os.getenv("CONV_MAX_SESSIONS", "10000")),
+    max_bytes=int(os.getenv("CONV_MAX_BYTES", str(256 * 1024 * 1024))),
+    idle_ttl=float(os.getenv("CONV_IDLE_TTL", str(6 * 3600))),
+    store=_default_store(),
+)
+atexit.register(conv_manager.store.close)
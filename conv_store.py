@@ -0,0 +1,233 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks are process-local only
+    fcntl = None
+
+# Storage backends for ConversationManager. The manager keeps hot sessions in
+# memory and calls into a store to persist appends and to lazy-load a session the
+# first time it is touched (e.g. after a restart or an idle eviction).
+# A shared store also versions each session so several worker processes can keep
+# their in-memory copies coherent, and hands out cross-process per-session locks.
+
+
+class SessionLocks:
+    """Striped per-session locks: a thread lock plus, when available, an flock on a stripe file"""
+
+    def __init__(self, lock_dir: Optional[str] = None, stripes: int = 256):
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self._thread_locks = [threading.Lock() for _ in range(stripes)]
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def _stripe(self, session_id: str) -> int:
+        return int(hashlib.md5(session_id.encode("utf-8")).hexdigest()[:8], 16) % self.stripes
+
+    @contextmanager
+    def hold(self, session_id: str):
+        stripe = self._stripe(session_id)
+        with self._thread_locks[stripe]:
+            if not (self.lock_dir and fcntl):
+                yield
+                return
+            with open(os.path.join(self.lock_dir, f"{stripe:03d}.lock"), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ConversationStore:
+    """Backend interface; the base class persists nothing"""
+
+    shared = False
+
+    def __init__(self):
+        self.locks = SessionLocks()
+
+    def lock(self, session_id: str):
+        """Context manager serializing one session's turns"""
+        return self.locks.hold(session_id)
+
+    def version(self, session_id: str) -> Optional[int]:
+        """Current version of a session (shared stores only; None = no coherence checks)"""
+        return None
+
+    def load(self, session_id: str, max_history: int) -> Optional[Tuple[Optional[str], Optional[str], List[dict]]]:
+        """(system_prompt, its meta, last max_history turns) or None if the session is unknown"""
+        return None
+
+    def append(self, session_id: str, role: str, content: str, meta: Optional[str] = None) -> Optional[int]:
+        """Persist one message (meta: caller's tag for a system prompt); shared stores return the new version"""
+        return None
+
+    def delete(self, session_id: str):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": "memory"}
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Append-only message log in SQLite with write-behind and periodic compaction.
+
+    Appends are buffered and written in one transaction every flush_interval
+    seconds. Every snapshot_interval seconds the log is compacted down to each
+    session's latest system prompt and last keep_turns turns. With shared=True
+    (several worker processes on one file) appends are written through and bump
+    a per-session version instead, and session locks also hold an flock.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 0.5, snapshot_interval: float = 300.0,
+                 keep_turns: int = 20, shared: bool = False):
+        self.path = path
+        self.shared = shared
+        self.locks = SessionLocks(lock_dir=f"{path}.locks" if shared else None)
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.keep_turns = keep_turns
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=5.0)
+        self._db_lock = threading.Lock()
+        with self._db_lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    ts REAL NOT NULL,
+                    meta TEXT
+                )""")
+            if "meta" not in [row[1] for row in self._db.execute("PRAGMA table_info(messages)")]:
+                self._db.execute("ALTER TABLE messages ADD COLUMN meta TEXT")  # databases from before meta
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, seq)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS versions (session_id TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+            self._db.commit()
+
+        self._pending: List[tuple] = []
+        self._pending_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._last_snapshot = time.time()
+        self.flushes = 0
+        self.snapshots = 0
+        self.loads = 0
+        self._worker = threading.Thread(target=self._run, name="conv-store", daemon=True)
+        self._worker.start()
+
+    def load(self, session_id: str, max_history: int):
+        self.flush()  # a just-written turn must be visible to the reload
+        with self._db_lock:
+            system = self._db.execute(
+                "SELECT content, meta FROM messages WHERE session_id = ? AND role = 'system' ORDER BY seq DESC LIMIT 1",
+                (session_id,)).fetchone()
+            rows = self._db.execute(
+                "SELECT role, content FROM messages WHERE session_id = ? AND role != 'system' ORDER BY seq DESC LIMIT ?",
+                (session_id, max_history)).fetchall()
+        if system is None and not rows:
+            return None
+        self.loads += 1
+        turns = [{"role": role, "content": content} for role, content in reversed(rows)]
+        system, meta = system if system else (None, None)
+        return system, meta, turns
+
+    def append(self, session_id: str, role: str, content: str, meta: Optional[str] = None) -> Optional[int]:
+        if not self.shared:
+            with self._pending_lock:
+                self._pending.append((session_id, role, content, time.time(), meta))
+            return None
+        # Shared: write through so other workers see the turn, and bump the session version
+        with self._db_lock:
+            self._db.execute("INSERT INTO messages (session_id, role, content, ts, meta) VALUES (?, ?, ?, ?, ?)",
+                             (session_id, role, content, time.time(), meta))
+            self._db.execute("INSERT INTO versions (session_id, version) VALUES (?, 1) "
+                             "ON CONFLICT(session_id) DO UPDATE SET version = version + 1", (session_id,))
+            version = self._db.execute("SELECT version FROM versions WHERE session_id = ?", (session_id,)).fetchone()[0]
+            self._db.commit()
+        return version
+
+    def version(self, session_id: str) -> Optional[int]:
+        if not self.shared:
+            return None
+        with self._db_lock:
+            row = self._db.execute("SELECT version FROM versions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else 0
+
+    def delete(self, session_id: str):
+        self.flush()
+        with self._db_lock:
+            self._db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            if self.shared:
+                self._db.execute("INSERT INTO versions (session_id, version) VALUES (?, 1) "
+                                 "ON CONFLICT(session_id) DO UPDATE SET version = version + 1", (session_id,))
+            self._db.commit()
+
+    def flush(self):
+        with self._pending_lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            with self._db_lock:
+                self._db.executemany("INSERT INTO messages (session_id, role, content, ts, meta) VALUES (?, ?, ?, ?, ?)",
+                                     batch)
+                self._db.commit()
+            self.flushes += 1
+        except Exception as e:
+            print("Conversation store flush error:", e)
+            with self._pending_lock:
+                self._pending[:0] = batch
+
+    def snapshot(self):
+        """Compact the log to what a reload needs: latest system prompt + last keep_turns turns"""
+        self.flush()
+        with self._db_lock:
+            self._db.execute("""
+                DELETE FROM messages WHERE seq IN (
+                    SELECT seq FROM (
+                        SELECT seq, ROW_NUMBER() OVER (
+                            PARTITION BY session_id, role = 'system' ORDER BY seq DESC
+                        ) AS rn, role FROM messages
+                    ) WHERE (role = 'system' AND rn > 1) OR (role != 'system' AND rn > ?)
+                )""", (self.keep_turns,))
+            self._db.commit()
+        self.snapshots += 1
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+            if time.time() - self._last_snapshot >= self.snapshot_interval:
+                self._last_snapshot = time.time()
+                try:
+                    self.snapshot()
+                except Exception as e:
+                    print("Conversation store snapshot error:", e)
+
+    def close(self):
+        self._closed.set()
+        self._worker.join(timeout=5.0)
+        self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "shared": self.shared,
+            "pending_writes": len(self._pending),
+            "flushes": self.flushes,
+            "snapshots": self.snapshots,
+            "lazy_loads": self.loads,
+        }
@@ -0,0 +1,82 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+
+# Micro-batcher for embedding requests. Concurrent callers drop their text on a
+# shared queue; a single worker waits up to max_wait for up to max_batch texts and
+# sends them as ONE embeddings request, then resolves each caller's future.
+
+
+class EmbeddingBatcher:
+    def __init__(self, embed_many: Callable[[List[str]], List[List[float]]],
+                 max_batch: int = 64, max_wait: float = 0.005):
+        self.embed_many = embed_many
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.unique_items = 0
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+                self._worker.start()
+
+    def submit(self, text: str) -> Future:
+        self._ensure_worker()
+        fut: Future = Future()
+        self._queue.put((text, fut))
+        return fut
+
+    def embed(self, text: str, timeout: Optional[float] = None) -> List[float]:
+        return self.submit(text).result(timeout=timeout)
+
+    def _collect(self) -> List[tuple]:
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # Identical texts in one window share a single input slot
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = dict(zip(texts, self.embed_many(texts)))
+                for text, fut in batch:
+                    fut.set_result(vectors[text])
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+            self.batches += 1
+            self.items += len(batch)
+            self.unique_items += len(texts)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "unique_items": self.unique_items,
+            "max_batch": self.max_batch,
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else None,
+            "fill_ratio": round(self.items / (self.batches * self.max_batch), 4) if self.batches else None,
+            "queue_depth": self._queue.qsize(),
+        }
@@ -0,0 +1,75 @@
+import hashlib
+import sqlite3
+import threading
+from array import array
+from typing import List, Optional
+
+from cache import LRUCache
+
+# Content-addressed embedding cache: (model, sha256(text)) -> float32 vector.
+# Tier 1 is a bounded in-memory LRU; tier 2 is an optional SQLite file so
+# embeddings survive restarts. Both hold packed float32 arrays (~6 KB for 1536
+# dims, against ~50 KB as a list of Python floats); callers get a list back.
+
+
+def embedding_key(model: str, text: str) -> str:
+    return f"{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+
+class EmbeddingCache:
+    def __init__(self, maxsize: int = 10000, path: Optional[str] = None):
+        self.memory = LRUCache(maxsize=maxsize)
+        self.path = path
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self._db = None
+        self._db_lock = threading.Lock()
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB NOT NULL)")
+                self._db.commit()
+            except Exception as e:
+                print("Embedding cache disk tier disabled:", e)
+                self._db = None
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        key = embedding_key(model, text)
+        packed = self.memory.get(key)
+        if packed is not None:
+            return packed.tolist()
+        if self._db is None:
+            return None
+        with self._db_lock:
+            row = self._db.execute("SELECT vec FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.disk_misses += 1
+            return None
+        self.disk_hits += 1
+        packed = array("f", row[0])
+        self.memory.put(key, packed)
+        return packed.tolist()
+
+    def put(self, model: str, text: str, vec: List[float]):
+        key = embedding_key(model, text)
+        packed = array("f", vec)
+        self.memory.put(key, packed)
+        if self._db is None:
+            return
+        try:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+                    (key, packed.tobytes()),
+                )
+                self._db.commit()
+        except Exception as e:
+            print("Embedding cache write error:", e)
+
+    def stats(self) -> dict:
+        stats = self.memory.stats()
+        stats["disk_enabled"] = self._db is not None
+        stats["disk_hits"] = self.disk_hits
+        stats["disk_misses"] = self.disk_misses
+        return stats
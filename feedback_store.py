@@ -0,0 +1,212 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+# Local structured store for feedback records (user_progress, learning_experience, ...).
+# SQLite in WAL mode with an index on (session_id, feedback_type, timestamp), so
+# "last N records for this learner" is an indexed range read instead of a vector query.
+
+# Per-session user_progress rollups keep at most this many points in the trend lists
+ROLLUP_TREND_POINTS = 50
+
+_COLUMNS = ("id", "session_id", "message_pair_id", "feedback_type", "timestamp",
+            "grammar_score", "estimated_level", "vocabulary_level", "feedback_data_json")
+
+
+class FeedbackStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        db = self._conn()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS feedback (
+                id TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                message_pair_id TEXT,
+                feedback_type TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                grammar_score REAL,
+                estimated_level TEXT,
+                vocabulary_level TEXT,
+                feedback_data_json TEXT NOT NULL
+            )""")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_feedback_session ON feedback (session_id, feedback_type, timestamp)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_feedback_type ON feedback (feedback_type, timestamp)")
+        # Bumped on every write for a session; lets each worker validate its cached copies
+        db.execute("CREATE TABLE IF NOT EXISTS feedback_versions (session_id TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS progress_rollup (
+                session_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                rollup_json TEXT NOT NULL
+            )""")
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; WAL lets readers run alongside the writer
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+            db = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _version(db, session_id: str) -> int:
+        row = db.execute("SELECT version FROM feedback_versions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else 0
+
+    def version(self, session_id: str) -> int:
+        """Write counter for a session's feedback (shared by every process using this file)"""
+        return self._version(self._conn(), session_id)
+
+    def insert_many(self, records: List[dict]) -> dict:
+        """Insert records in one transaction; returns {session_id: new feedback version}"""
+        rows = [
+            (r["id"], r["session_id"], r.get("message_pair_id"), r["feedback_type"], r["timestamp"],
+             r.get("grammar_score"), r.get("estimated_level"), r.get("vocabulary_level"),
+             json.dumps(r.get("feedback_data", {})))
+            for r in records
+        ]
+        progress = [r for r in records if r["feedback_type"] == "user_progress"]
+        db = self._conn()
+        # Take the write lock up front so the rollup read-modify-write can't interleave
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Load rollups before inserting so a first-time rebuild doesn't count these rows twice
+            rollups = {sid: self._load_rollup(db, sid) for sid in dict.fromkeys(r["session_id"] for r in progress)}
+            db.executemany(f"INSERT OR REPLACE INTO feedback ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})", rows)
+            for r in progress:
+                apply_progress(rollups[r["session_id"]][1], r.get("feedback_data", {}), r["timestamp"])
+            for session_id, (version, rollup) in rollups.items():
+                self._save_rollup(db, session_id, version + 1, rollup)
+            versions = {}
+            for session_id in dict.fromkeys(r["session_id"] for r in records):
+                db.execute("INSERT INTO feedback_versions (session_id, version) VALUES (?, 1) "
+                           "ON CONFLICT(session_id) DO UPDATE SET version = version + 1", (session_id,))
+                versions[session_id] = self._version(db, session_id)
+            db.execute("COMMIT")
+            return versions
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def _load_rollup(self, db, session_id: str) -> Tuple[int, dict]:
+        row = db.execute("SELECT version, rollup_json FROM progress_rollup WHERE session_id = ?", (session_id,)).fetchone()
+        if row is not None:
+            return row[0], json.loads(row[1])
+        # No rollup yet (e.g. rows written before rollups existed): rebuild once from history
+        rollup = new_rollup()
+        for ts, data in db.execute(
+                "SELECT timestamp, feedback_data_json FROM feedback WHERE session_id = ? AND feedback_type = 'user_progress' ORDER BY timestamp",
+                (session_id,)):
+            apply_progress(rollup, json.loads(data), ts)
+        return 0, rollup
+
+    @staticmethod
+    def _save_rollup(db, session_id: str, version: int, rollup: dict):
+        db.execute("INSERT OR REPLACE INTO progress_rollup (session_id, version, rollup_json) VALUES (?, ?, ?)",
+                   (session_id, version, json.dumps(rollup)))
+
+    def get_rollup(self, session_id: str) -> Tuple[int, Optional[dict]]:
+        """(version, rollup) for a session's user_progress records; (0, None) if none"""
+        db = self._conn()
+        row = db.execute("SELECT version, rollup_json FROM progress_rollup WHERE session_id = ?", (session_id,)).fetchone()
+        if row is not None:
+            return row[0], json.loads(row[1])
+        has_rows = db.execute(
+            "SELECT 1 FROM feedback WHERE session_id = ? AND feedback_type = 'user_progress' LIMIT 1", (session_id,)
+        ).fetchone()
+        if not has_rows:
+            return 0, None
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            version, rollup = self._load_rollup(db, session_id)
+            if version == 0:
+                version = 1
+                self._save_rollup(db, session_id, version, rollup)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return version, rollup
+
+    def query(self, feedback_type: Optional[str] = None, session_id: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None, limit: int = 50) -> List[dict]:
+        """Latest `limit` matching records, returned oldest first"""
+        clauses, params = [], []
+        for column, value in (("session_id", session_id), ("feedback_type", feedback_type)):
+            if value:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp <= ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._conn().execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM feedback {where} ORDER BY timestamp DESC LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        return [self._to_record(row) for row in reversed(rows)]
+
+    @staticmethod
+    def _to_record(row) -> dict:
+        record = {"type": "feedback"}
+        for column, value in zip(_COLUMNS, row):
+            if column == "feedback_data_json":
+                try:
+                    record["feedback_data"] = json.loads(value)
+                except ValueError:
+                    record["feedback_data"] = {}
+            elif value is not None:
+                record[column] = value
+        return record
+
+
+def new_rollup() -> dict:
+    return {
+        "count": 0,
+        "grammar_sum": 0.0,
+        "grammar_count": 0,
+        "grammar_trend": [],
+        "level_progression": [],
+        "error_counts": {},
+        "per_day": {},
+        "updated": None,
+    }
+
+
+def apply_progress(rollup: dict, feedback_data: dict, timestamp: float):
+    """Fold one user_progress record into a session rollup (in place)"""
+    rollup["count"] += 1
+    rollup["updated"] = timestamp
+    day = time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+    rollup["per_day"][day] = rollup["per_day"].get(day, 0) + 1
+    if not isinstance(feedback_data, dict):
+        return
+
+    # Safely extract grammar score
+    if "grammar_score" in feedback_data:
+        score = feedback_data["grammar_score"]
+        rollup["grammar_trend"] = (rollup["grammar_trend"] + [score])[-ROLLUP_TREND_POINTS:]
+        try:
+            rollup["grammar_sum"] += float(score)
+            rollup["grammar_count"] += 1
+        except (TypeError, ValueError):
+            pass
+
+    # Safely extract level
+    if "estimated_level" in feedback_data:
+        rollup["level_progression"] = (rollup["level_progression"] + [feedback_data["estimated_level"]])[-ROLLUP_TREND_POINTS:]
+
+    # Safely extract errors
+    for err in feedback_data.get("errors", []) or []:
+        if isinstance(err, dict):
+            error_type = err.get("type", "unknown")
+            rollup["error_counts"][error_type] = rollup["error_counts"].get(error_type, 0) + 1
@@ -0,0 +1,129 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+# In-process background job queue: a fixed pool of worker threads draining a
+# bounded priority queue. When the queue is full the lowest-priority job is shed
+# (either the newcomer or the worst queued job), so a traffic spike costs dropped
+# analysis instead of thousands of threads.
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+
+
+class Job:
+    __slots__ = ("name", "fn", "args", "kwargs", "priority", "enqueued")
+
+    def __init__(self, name, fn, args, kwargs, priority):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.enqueued = time.time()
+
+
+class JobQueue:
+    def __init__(self, workers: int = 4, max_queue: int = 1000, name: str = "jobs"):
+        self.name = name
+        self.max_queue = max_queue
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._running = 0
+        self._wait_ms = deque(maxlen=500)
+        self._run_ms = deque(maxlen=500)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self._workers = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._workers:
+            t.start()
+
+    def submit(self, name: str, fn: Callable, *args, priority: int = PRIORITY_NORMAL, **kwargs) -> bool:
+        """Queue a job; returns False if it was shed"""
+        job = Job(name, fn, args, kwargs, priority)
+        with self._cond:
+            if self._closed:
+                self.dropped += 1
+                return False
+            if len(self._heap) >= self.max_queue:
+                # Shed whichever is least important: the newcomer or the worst queued job
+                worst = max(range(len(self._heap)), key=lambda i: self._heap[i][:2])
+                if self._heap[worst][0] <= priority:
+                    self.dropped += 1
+                    print(f"[Jobs] queue full, dropped {name}")
+                    return False
+                shed = self._heap[worst][2]
+                self._heap[worst] = self._heap[-1]
+                self._heap.pop()
+                heapq.heapify(self._heap)
+                self.dropped += 1
+                print(f"[Jobs] queue full, shed {shed.name}")
+            heapq.heappush(self._heap, (priority, next(self._seq), job))
+            self.submitted += 1
+            self._cond.notify()
+        return True
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._heap or self._closed)
+                if not self._heap:
+                    return
+                _, _, job = heapq.heappop(self._heap)
+                self._running += 1
+            started = time.time()
+            self._wait_ms.append((started - job.enqueued) * 1000)
+            try:
+                job.fn(*job.args, **job.kwargs)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"[Jobs] {job.name} failed:", e)
+            finally:
+                self._run_ms.append((time.time() - started) * 1000)
+                with self._cond:
+                    self._running -= 1
+
+    def close(self, timeout: float = 10.0):
+        """Stop accepting jobs and let workers drain what is queued"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for t in self._workers:
+            t.join(timeout=timeout)
+
+    @staticmethod
+    def _summary(samples) -> dict:
+        values = sorted(samples)
+        if not values:
+            return {"avg": None, "p95": None, "max": None}
+        return {
+            "avg": round(sum(values) / len(values), 1),
+            "p95": round(values[min(len(values) - 1, int(len(values) * 0.95))], 1),
+            "max": round(values[-1], 1),
+        }
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._workers),
+            "depth": len(self._heap),
+            "max_queue": self.max_queue,
+            "running": self._running,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "queue_wait_ms": self._summary(list(self._wait_ms)),
+            "run_ms": self._summary(list(self._run_ms)),
+        }
@@ -1,11 +1,31 @@
-import os, time, uuid, json
-from typing import List
+import os, time, uuid, threading, atexit
+from collections import OrderedDict
+from typing import Dict, List
 from openai import OpenAI
 from dotenv import load_dotenv
+from embed_cache import EmbeddingCache
+from embed_batcher import EmbeddingBatcher
+from write_behind import WriteBehindQueue
+from feedback_store import FeedbackStore
+from circuit_breaker import breaker_from_env
+from pipeline import Deadline
 load_dotenv(override=True)  # Changed: add override=True to match routes.py
 
 EMBED_MODEL = "text-embedding-3-small"
-_openai = OpenAI()
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "3.0"))
+PINECONE_TIMEOUT = float(os.getenv("PINECONE_TIMEOUT", "2.0"))
+_openai = OpenAI(timeout=EMBED_TIMEOUT, max_retries=int(os.getenv("EMBED_RETRIES", "1")))
+
+# Fast-fail once a dependency is mostly failing, instead of every caller waiting it out
+pinecone_breaker = breaker_from_env("pinecone")
+embedding_breaker = breaker_from_env("openai_embeddings")
+
+# Embedding cache: in-memory LRU + optional SQLite tier (set EMBED_CACHE_PATH to enable)
+_embed_cache = EmbeddingCache(
+    maxsize=int(os.getenv("EMBED_CACHE_SIZE", "10000")),
+    path=os.getenv("EMBED_CACHE_PATH") or None,
+)
+_embed_api_calls = 0
 
 # Lazy Pinecone
 _PINECONE_KEY = os.getenv("PINECONE_API_KEY")
@@ -30,9 +50,62 @@ def _lazy():
     except Exception as e:
         print("Pinecone init failed:", e)
 
-def _embed(text: str) -> List[float]:
-    r = _openai.embeddings.create(model=EMBED_MODEL, input=text)
-    return r.data[0].embedding
+def _budget(deadline: Deadline, cap: float) -> float:
+    """Per-call timeout within the request deadline; raises once the deadline is spent"""
+    timeout = deadline.timeout(cap) if deadline is not None else cap
+    if timeout <= 0:
+        raise TimeoutError("request deadline exceeded")
+    return timeout
+
+def _upsert(namespace: str, vectors: List[dict]):
+    # Failures (or an open breaker) go back to the write-behind queue's retry / dead-letter path
+    pinecone_breaker.call(_index.upsert, vectors=vectors, namespace=namespace,
+                          _request_timeout=float(os.getenv("PINECONE_UPSERT_TIMEOUT", "10")))
+
+# Write-behind persistence: vectors are buffered and upserted in per-namespace batches
+_writer = WriteBehindQueue(
+    _upsert,
+    batch_size=int(os.getenv("UPSERT_BATCH_SIZE", "100")),
+    flush_interval=float(os.getenv("UPSERT_FLUSH_INTERVAL", "1.0")),
+    max_pending=int(os.getenv("UPSERT_MAX_PENDING", "5000")),
+    dead_letter_path=os.getenv("UPSERT_DEAD_LETTER", os.path.join(os.path.dirname(__file__), "upsert_dead_letter.jsonl")),
+)
+atexit.register(_writer.close)
+
+def write_behind_stats() -> dict:
+    return _writer.stats()
+
+def _embed_many(texts: List[str]) -> List[List[float]]:
+    global _embed_api_calls
+    r = embedding_breaker.call(_openai.embeddings.create, model=EMBED_MODEL, input=texts)
+    _embed_api_calls += 1
+    return [d.embedding for d in sorted(r.data, key=lambda d: d.index)]
+
+# Concurrent store_message / store_feedback / semantic_search callers share batched requests
+_embed_batcher = EmbeddingBatcher(
+    _embed_many,
+    max_batch=int(os.getenv("EMBED_BATCH_MAX", "64")),
+    max_wait=float(os.getenv("EMBED_BATCH_WAIT_MS", "5")) / 1000,
+)
+
+def _embed(text: str, timeout: float = None) -> List[float]:
+    vec = _embed_cache.get(EMBED_MODEL, text)
+    if vec is not None:
+        return vec
+    vec = _embed_batcher.embed(text, timeout=timeout)
+    _embed_cache.put(EMBED_MODEL, text, vec)
+    return vec
+
+def embedding_cache_stats() -> dict:
+    stats = _embed_cache.stats()
+    stats["api_calls"] = _embed_api_calls
+    return stats
+
+def embedding_batch_stats() -> dict:
+    return _embed_batcher.stats()
+
+def breaker_stats() -> dict:
+    return {"pinecone": pinecone_breaker.stats(), "openai_embeddings": embedding_breaker.stats()}
 
 def store_message(session_id: str, role: str, content: str):
     _lazy()
@@ -40,100 +113,101 @@ def store_message(session_id: str, role: str, content: str):
         return
     try:
         vec = _embed(content)
-        print(f"[Pinecone] storing {role} message for session {session_id}")
-        _index.upsert(vectors=[{
+        print(f"[Pinecone] queueing {role} message for session {session_id}")
+        _writer.put(session_id, {
             "id": f"{session_id}-{int(time.time()*1000)}-{role}-{uuid.uuid4().hex[:8]}",
             "values": vec,
             "metadata": {"session_id": session_id, "role": role, "content": content}
-        }], namespace=session_id)
-        print(f"[Pinecone] stored successfully")
+        })
     except Exception as e:
         print("Pinecone store error:", e)
 
+# Structured feedback lives in a local SQLite store; Pinecone only holds what semantic search needs
+_feedback_store = FeedbackStore(os.getenv("FEEDBACK_DB_PATH", os.path.join(os.path.dirname(__file__), "feedback.sqlite")))
+
+def _feedback_record(session_id: str, message_pair_id: str, feedback_type: str, feedback_data: dict) -> dict:
+    record = {
+        "type": "feedback",
+        "id": f"feedback-{session_id}-{int(time.time()*1000)}-{uuid.uuid4().hex[:8]}",
+        "session_id": session_id,
+        "message_pair_id": message_pair_id,
+        "feedback_type": feedback_type,
+        "feedback_data": feedback_data,
+        "timestamp": time.time()
+    }
+    
+    # Extract key fields as separate columns for easier querying
+    if isinstance(feedback_data, dict):
+        for key in ("grammar_score", "estimated_level", "vocabulary_level"):
+            if key in feedback_data:
+                record[key] = feedback_data[key]
+    return record
+
+# Callbacks run with a session_id after feedback for that session is written (cache invalidation)
+_feedback_listeners = []
+
+def on_feedback_write(callback):
+    _feedback_listeners.append(callback)
+
+def get_feedback_version(session_id: str) -> int:
+    return _feedback_store.version(session_id)
+
+def _write_feedback(records: List[dict]):
+    versions = _feedback_store.insert_many(records)
+    # One version bump per session per batch, so each session's records are patched in together
+    for session_id, version in versions.items():
+        learning = [r for r in records if r["session_id"] == session_id and r["feedback_type"] == "learning_experience"]
+        _add_to_learning_index(session_id, learning, version)
+    for session_id in dict.fromkeys(r["session_id"] for r in records):
+        for callback in _feedback_listeners:
+            try:
+                callback(session_id)
+            except Exception as e:
+                print("Feedback listener error:", e)
+
 # Add feedback storage function
 def store_feedback(session_id: str, message_pair_id: str, feedback_type: str, feedback_data: dict):
     """Store feedback about AI responses for continuous learning"""
-    _lazy()
-    if not _index:
-        return
     try:
-        # Create embedding from the feedback context
-        context = f"{feedback_type}: {feedback_data.get('issue', '')} {feedback_data.get('suggestion', '')}"
-        vec = _embed(context)
-        
-        vid = f"feedback-{session_id}-{int(time.time()*1000)}-{uuid.uuid4().hex[:8]}"
-        
-        # FIXED: Flatten complex data to strings for Pinecone metadata
-        meta = {
-            "type": "feedback",
-            "session_id": session_id,
-            "message_pair_id": message_pair_id,
-            "feedback_type": feedback_type,
-            "feedback_data_json": json.dumps(feedback_data),  # Convert to JSON string
-            "timestamp": time.time()
-        }
-        
-        # Extract key fields as separate metadata for easier querying
-        if isinstance(feedback_data, dict):
-            if "grammar_score" in feedback_data:
-                meta["grammar_score"] = feedback_data["grammar_score"]
-            if "estimated_level" in feedback_data:
-                meta["estimated_level"] = feedback_data["estimated_level"]
-            if "vocabulary_level" in feedback_data:
-                meta["vocabulary_level"] = feedback_data["vocabulary_level"]
-        
-        _index.upsert(vectors=[{"id": vid, "values": vec, "metadata": meta}], namespace="feedback")
+        _write_feedback([_feedback_record(session_id, message_pair_id, feedback_type, feedback_data)])
         print(f"[Feedback] stored {feedback_type} feedback")
     except Exception as e:
         print("Feedback store error:", e)
 
-def get_feedback_patterns(feedback_type: str = None, limit: int = 50):
-    """Retrieve feedback patterns for analysis"""
-    _lazy()
-    if not _index:
-        return []
+def store_feedback_batch(session_id: str, feedback_type: str, items: List[tuple]):
+    """Store several (message_pair_id, feedback_data) records in one insert"""
+    try:
+        _write_feedback([_feedback_record(session_id, pair_id, feedback_type, data) for pair_id, data in items])
+        print(f"[Feedback] stored {len(items)} {feedback_type} feedback records")
+    except Exception as e:
+        print("Feedback store error:", e)
+
+def get_feedback_patterns(feedback_type: str = None, limit: int = 50, session_id: str = None,
+                          since: float = None, until: float = None):
+    """Retrieve the latest feedback records, oldest first"""
     try:
-        # Query feedback namespace
-        query_filter = {"type": "feedback"}
-        if feedback_type:
-            query_filter["feedback_type"] = feedback_type
-            
-        # Use a dummy vector for metadata-only search
-        dummy_vec = [0.0] * 1536
-        res = _index.query(
-            vector=dummy_vec,
-            top_k=limit,
-            namespace="feedback",
-            include_metadata=True,
-            filter=query_filter
-        )
-        
-        # Parse JSON data back to objects
-        results = []
-        for match in res.get("matches", []):
-            meta = match["metadata"].copy()
-            # Parse JSON string back to dict
-            if "feedback_data_json" in meta:
-                try:
-                    import json
-                    meta["feedback_data"] = json.loads(meta["feedback_data_json"])
-                    del meta["feedback_data_json"]  # Remove the JSON string version
-                except:
-                    meta["feedback_data"] = {}
-            results.append(meta)
-        
-        return results
+        return _feedback_store.query(feedback_type=feedback_type, session_id=session_id,
+                                     since=since, until=until, limit=limit)
     except Exception as e:
         print("Feedback retrieval error:", e)
         return []
 
-def semantic_search(session_id: str, query: str, top_k: int = 5):
+def get_progress_rollup(session_id: str):
+    """(version, rollup) of a session's user_progress records, maintained on every write"""
+    return _feedback_store.get_rollup(session_id)
+
+def semantic_search(session_id: str, query: str, top_k: int = 5, deadline: Deadline = None, strict: bool = False):
+    """Similar stored messages; [] if Pinecone is off, failing, or the deadline runs out.
+
+    With strict, failures and a spent deadline raise instead, so a pipeline stage can report them.
+    """
     _lazy()
     if not _index:
         return []
     try:
-        qv = _embed(query)
-        res = _index.query(vector=qv, top_k=top_k, namespace=session_id, include_metadata=True)
+        qv = _embed(query, timeout=_budget(deadline, EMBED_TIMEOUT))
+        res = pinecone_breaker.call(_index.query, vector=qv, top_k=top_k, namespace=session_id,
+                                    include_metadata=True, _request_timeout=_budget(deadline, PINECONE_TIMEOUT))
         return [
             {
                 "score": m.get("score"),
@@ -142,5 +216,49 @@ def semantic_search(session_id: str, query: str, top_k: int = 5):
             } for m in res.get("matches", [])
         ]
     except Exception as e:
+        if strict:
+            raise
         print("Pinecone search error:", e)
-        return []
\ No newline at end of file
+        return []
+
+# Per-session index of learning_experience feedback keyed by the ai_response it
+# refers to. Built with ONE feedback fetch the first time a session needs it, then
+# kept current by store_feedback so later turns never re-query. Each index carries
+# the feedback version it reflects, so writes from other workers trigger a rebuild.
+_LEARNING_INDEX_MAX_SESSIONS = int(os.getenv("LEARNING_INDEX_MAX_SESSIONS", "1000"))
+_learning_index: "OrderedDict[str, tuple]" = OrderedDict()  # session_id -> (version, index)
+_learning_index_lock = threading.Lock()
+
+def _index_record(idx: Dict[str, List[dict]], record: dict):
+    ai_response = (record.get("feedback_data") or {}).get("ai_response")
+    if ai_response:
+        idx.setdefault(ai_response, []).append(record)
+
+def _add_to_learning_index(session_id: str, records: List[dict], version: int):
+    with _learning_index_lock:
+        entry = _learning_index.get(session_id)
+        # Only patch in place if no other writer got in between; otherwise the next read rebuilds
+        if entry is not None and entry[0] == version - 1:
+            for record in records:
+                _index_record(entry[1], record)
+            _learning_index[session_id] = (version, entry[1])
+
+def get_learning_feedback_index(session_id: str) -> Dict[str, List[dict]]:
+    """ai_response -> learning_experience feedback records for this session (read-only)"""
+    version = get_feedback_version(session_id)
+    with _learning_index_lock:
+        entry = _learning_index.get(session_id)
+        if entry is not None and entry[0] == version:
+            _learning_index.move_to_end(session_id)
+            return entry[1]
+
+    idx = {}
+    for f in get_feedback_patterns(feedback_type="learning_experience", limit=20, session_id=session_id):
+        _index_record(idx, f)
+
+    with _learning_index_lock:
+        _learning_index[session_id] = (version, idx)
+        _learning_index.move_to_end(session_id)
+        while len(_learning_index) > _LEARNING_INDEX_MAX_SESSIONS:
+            _learning_index.popitem(last=False)
+    return idx
@@ -0,0 +1,135 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, List, Optional
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
+# Staged executor for the converse pipeline.
+# Independent stages (personalization, contextual feedback) run on a shared bounded
+# pool and fire-and-forget persistence on a separate one; the request thread only
+# waits on the stages it actually needs, each with its own timeout. A request-wide Deadline caps every stage timeout, and
+# stages whose dependency's circuit breaker is open are skipped without being run.
+
+DEFAULT_STAGE_TIMEOUT = float(os.getenv("STAGE_TIMEOUT", "4.0"))
+
+
+class Deadline:
+    """Time budget of one request, shared by every outbound call made for it"""
+
+    def __init__(self, seconds: float):
+        self.expires = time.time() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.time())
+
+    def timeout(self, cap: float) -> float:
+        """Timeout for one call: its own cap, or less if the request budget is nearly spent"""
+        return min(cap, self.remaining())
+
+
+class Stage:
+    def __init__(self, name: str, future, timeout: float, started: float):
+        self.name = name
+        self.future = future
+        self.timeout = timeout
+        self.started = started
+        self.status = "pending"  # pending | ok | timeout | error | skipped
+        self.reason: Optional[str] = None
+        self.elapsed: Optional[float] = None
+
+    def result(self, default: Any = None) -> Any:
+        """Wait up to the stage timeout; return default on timeout, error or skip"""
+        if self.future is None:
+            return default  # skipped before it started
+        remaining = max(0.0, self.timeout - (time.time() - self.started))
+        try:
+            value = self.future.result(timeout=remaining)
+            self.status = "ok"
+            return value
+        except (FutureTimeout, TimeoutError) as e:
+            self.status = "timeout"
+            if self.future.done():
+                self.reason = str(e) or None  # the stage itself ran out of the request deadline
+                print(f"[Pipeline] stage '{self.name}' timed out:", e)
+            else:
+                print(f"[Pipeline] stage '{self.name}' timed out after {self.timeout:.2f}s")
+            return default
+        except CircuitOpenError as e:
+            self.status, self.reason = "skipped", str(e)
+            return default
+        except Exception as e:
+            self.status = "error"
+            print(f"[Pipeline] stage '{self.name}' failed:", e)
+            return default
+        finally:
+            self.elapsed = time.time() - self.started
+
+
+class StageRun:
+    """The set of stages belonging to one request"""
+
+    def __init__(self, executor: "StagedExecutor", deadline: Optional[Deadline] = None):
+        self._executor = executor
+        self.deadline = deadline
+        self.stages: List[Stage] = []
+
+    def submit(self, name: str, fn: Callable, *args, timeout: float = None,
+               breaker: Optional[CircuitBreaker] = None, **kwargs) -> Stage:
+        """Start a stage the request will wait on (skipped if breaker is open or the deadline is spent)"""
+        timeout = timeout if timeout is not None else self._executor.timeout_for(name)
+        if self.deadline is not None:
+            timeout = self.deadline.timeout(timeout)
+        if breaker is not None and not breaker.available():
+            return self.skip(name, f"{breaker.name} circuit open")
+        if timeout <= 0:
+            return self.skip(name, "deadline exceeded")
+        future = self._executor.pool.submit(fn, *args, **kwargs)
+        stage = Stage(name, future, timeout, time.time())
+        self.stages.append(stage)
+        return stage
+
+    def skip(self, name: str, reason: str) -> Stage:
+        """Record a stage that was not run"""
+        stage = Stage(name, None, 0.0, time.time())
+        stage.status, stage.reason, stage.elapsed = "skipped", reason, 0.0
+        self.stages.append(stage)
+        return stage
+
+    def background(self, name: str, fn: Callable, *args, **kwargs):
+        """Start a fire-and-forget stage on the background pool; errors are logged, never raised"""
+        def _run():
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                print(f"[Pipeline] background stage '{name}' failed:", e)
+        self._executor.background_pool.submit(_run)
+
+    def skipped(self) -> Dict[str, str]:
+        """stage -> why its result was not used (skipped, timed out or failed)"""
+        return {s.name: s.reason or s.status for s in self.stages if s.status in ("skipped", "timeout", "error")}
+
+    def summary(self) -> Dict[str, dict]:
+        return {
+            s.name: {"status": s.status, "ms": round(s.elapsed * 1000) if s.elapsed is not None else None}
+            for s in self.stages
+        }
+
+
+class StagedExecutor:
+    def __init__(self, max_workers: int = 16, timeouts: Dict[str, float] = None, background_workers: int = 8):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage")
+        # Fire-and-forget work (persistence) gets its own threads: if an upstream stalls it,
+        # the stages a request is waiting on still find free workers
+        self.background_pool = ThreadPoolExecutor(max_workers=background_workers, thread_name_prefix="stage-bg")
+        self.timeouts = timeouts or {}
+
+    def timeout_for(self, name: str) -> float:
+        return self.timeouts.get(name, DEFAULT_STAGE_TIMEOUT)
+
+    def run(self, deadline: Optional[Deadline] = None) -> StageRun:
+        return StageRun(self, deadline)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+        self.background_pool.shutdown(wait=True)
@@ -0,0 +1,94 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+# Shared state of TTS playlists (async reply audio and sentence-pipelined audio).
+# The worker that synthesizes a playlist records each chunk's outcome here, so a
+# status poll, chunk fetch or stream that lands on another gunicorn worker can be
+# served from the shared tts_out/ directory without sticky sessions.
+
+
+class PlaylistStore:
+    def __init__(self, path: str, retention: float = 3600.0, prune_every: int = 200):
+        self.path = path
+        self.retention = retention  # playlists older than this are deleted
+        self.prune_every = prune_every
+        self._created = 0
+        self._local = threading.local()
+        db = self._conn()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS playlists (
+                id TEXT PRIMARY KEY,
+                created REAL NOT NULL,
+                options_json TEXT NOT NULL
+            )""")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_playlists_created ON playlists (created)")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS playlist_chunks (
+                playlist_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL,
+                file TEXT,
+                PRIMARY KEY (playlist_id, idx)
+            )""")
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; WAL lets readers run alongside the writer
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def create(self, playlist_id: str, sentences: List[str], options: dict, status: str = "pending"):
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("INSERT INTO playlists (id, created, options_json) VALUES (?, ?, ?)",
+                       (playlist_id, time.time(), json.dumps(options)))
+            db.executemany("INSERT INTO playlist_chunks (playlist_id, idx, text, status) VALUES (?, ?, ?, ?)",
+                           [(playlist_id, i, s, status) for i, s in enumerate(sentences)])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        self._created += 1
+        if self._created % self.prune_every == 0:
+            self.prune()
+
+    def finish(self, playlist_id: str, index: int, fname: Optional[str]):
+        """Record a chunk's outcome: its audio file, or None if synthesis failed"""
+        self._conn().execute("UPDATE playlist_chunks SET status = ?, file = ? WHERE playlist_id = ? AND idx = ?",
+                             ("ready" if fname else "failed", fname, playlist_id, index))
+
+    def load(self, playlist_id: str) -> Optional[dict]:
+        db = self._conn()
+        row = db.execute("SELECT created, options_json FROM playlists WHERE id = ?", (playlist_id,)).fetchone()
+        if row is None:
+            return None
+        chunks = db.execute("SELECT idx, text, status, file FROM playlist_chunks WHERE playlist_id = ? ORDER BY idx",
+                            (playlist_id,)).fetchall()
+        return {
+            "id": playlist_id,
+            "created": row[0],
+            "options": json.loads(row[1]),
+            "chunks": [{"index": i, "text": t, "status": s, "file": f} for i, t, s, f in chunks],
+        }
+
+    def prune(self):
+        cutoff = time.time() - self.retention
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM playlist_chunks WHERE playlist_id IN (SELECT id FROM playlists WHERE created < ?)",
+                       (cutoff,))
+            db.execute("DELETE FROM playlists WHERE created < ?", (cutoff,))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
@@ -1,16 +1,28 @@
 import os
-import uuid
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
-from gtts import gTTS
 from openai import OpenAI
 from conv_manager import conv_manager
 from dotenv import load_dotenv  # added
 # Update this import line at the top
-from pine_store import store_message, semantic_search, store_feedback, get_feedback_patterns
-import threading
+from pine_store import store_message, semantic_search, store_feedback, store_feedback_batch, get_feedback_patterns, get_learning_feedback_index, get_progress_rollup, get_feedback_version, on_feedback_write, embedding_cache_stats, embedding_batch_stats, write_behind_stats, pinecone_breaker, breaker_stats as store_breaker_stats
+import atexit
+import base64
+import functools
+import hashlib
+import hmac
+import json
 import time
-import requests
+import zlib
+from pipeline import Deadline, StagedExecutor
+from circuit_breaker import CircuitOpenError, breaker_from_env
+from cache import LRUCache
+from jobs import JobQueue, PRIORITY_LOW, PRIORITY_NORMAL
+from analysis_aggregator import AnalysisAggregator
+from context_builder import ContextBuilder
+from tts_engine import AUDIO_FORMATS, CONCAT_FORMATS, MIME_TYPES, audio_options, audio_store, breaker_stats as tts_breaker_stats, file_format, mime_type, render as render_tts, tts_cache
+from tts_pipeline import TTSPipeline
+from playlist_store import PlaylistStore
 
 
 app = Flask(__name__)
@@ -18,7 +30,12 @@ CORS(app)
 
 load_dotenv(override=True)  # load variables from .env if present
 
-feedback_cache = {}
+# Learner profiles used to personalize the system prompt
+feedback_cache = LRUCache(
+    maxsize=int(os.getenv("FEEDBACK_CACHE_SIZE", "5000")),
+    ttl=float(os.getenv("FEEDBACK_CACHE_TTL", "600")),
+)
+on_feedback_write(feedback_cache.invalidate)
 
 
 
@@ -26,9 +43,18 @@ api_key = os.getenv("OPENAI_API_KEY")
 if not api_key:
     raise RuntimeError("OPENAI_API_KEY not set")
 
-client = OpenAI(api_key=api_key)
-AUDIO_DIR = os.path.join(os.path.dirname(__file__), "tts_out")
-os.makedirs(AUDIO_DIR, exist_ok=True)
+# Background callers (analysis, summaries) get this timeout; the converse path uses its deadline
+client = OpenAI(api_key=api_key, timeout=float(os.getenv("OPENAI_TIMEOUT", "30")))
+chat_breaker = breaker_from_env("openai_chat")
+# Bounded TTS worker pool: async whole-reply audio and sentence-pipelined audio
+tts_pipeline = TTSPipeline(
+    render_tts,
+    peek=tts_cache.cached,  # fully cached audio is ready at once, not after a trip through the pool
+    max_workers=int(os.getenv("TTS_PIPELINE_WORKERS", "4")),
+    max_pending=int(os.getenv("TTS_MAX_PENDING", "500")),
+    # Chunk outcomes are shared so any gunicorn worker can serve a playlist's URLs
+    store=PlaylistStore(os.getenv("TTS_PLAYLIST_DB_PATH", os.path.join(os.path.dirname(__file__), "tts_playlists.sqlite"))),
+)
 
 SYSTEM_PROMPT = """You are Russell from the Pixar movie UP - an enthusiastic, curious Boy Scout who loves asking questions. You're helping someone practice their target language through natural conversation.
 
@@ -66,53 +92,196 @@ Keep responses SHORT and USER-FOCUSED while staying enthusiastic!"""
 def health():
     return {"status": "ok"}
 
-@app.route("/api/audio/<path:fname>")
-def get_audio(fname):
-    return send_from_directory(AUDIO_DIR, fname, mimetype="audio/mpeg", as_attachment=False)
+@app.route("/api/metrics")
+def metrics():
+    return jsonify(
+        conversations=conv_manager.stats(),
+        feedback_cache=feedback_cache.stats(),
+        embedding_cache=embedding_cache_stats(),
+        embedding_batches=embedding_batch_stats(),
+        write_behind=write_behind_stats(),
+        analysis_jobs=analysis_jobs.stats(),
+        analysis_batches=analysis_aggregator.stats(),
+        prompt_context=context_builder.stats(),
+        tts_pipeline=tts_pipeline.stats(),
+        tts_cache=tts_cache.stats(),
+        tts_breakers=tts_breaker_stats(),
+        breakers={"openai_chat": chat_breaker.stats(), **store_breaker_stats()},
+        audio_store=audio_store.stats(),
+    )
 
-@app.route("/api/converse", methods=["POST"])
-def converse():
-    data = request.get_json(force=True)
-    user_text = data.get("text", "").strip()
-    target_lang = data.get("lang", "en")
-    session_id = data.get("session_id") or "default"
-    tts = bool(data.get("tts", True))
+def send_audio(fname: str):
+    """Serve a stored audio file, recording the access for LRU retention"""
+    path = audio_store.path(fname)
+    if path is None or not os.path.exists(path):
+        return jsonify(error="Audio not found"), 404
+    audio_store.touch(fname)
+    return send_from_directory(os.path.dirname(path), fname, mimetype=mime_type(fname), as_attachment=False)
 
-    if not user_text:
-        return jsonify(error="Empty text"), 400
+def audio_fields(fmt) -> dict:
+    """audio_format / audio_mime_type of served audio (None while its format isn't known yet)"""
+    return {"audio_format": fmt, "audio_mime_type": MIME_TYPES.get(fmt, "application/octet-stream") if fmt else None}
 
-    # Add system prompt once with CACHED personalization
-    if not conv_manager.get_history(session_id):
-        # Cache feedback data for this session
-        if session_id not in feedback_cache:
-            user_feedback = get_feedback_patterns(feedback_type="user_progress", limit=5)
-            learning_feedback = get_feedback_patterns(feedback_type="learning_experience", limit=10)
-            
-            feedback_cache[session_id] = {
-                'session_feedback': [f for f in user_feedback if f.get('session_id') == session_id],
-                'session_learning': [f for f in learning_feedback if f.get('session_id') == session_id],
-                'timestamp': time.time()
-            }
-        
-        # Use cached data
-        cache_data = feedback_cache[session_id]
-        session_feedback = cache_data['session_feedback']
-        session_learning = cache_data['session_learning']
-        
-        # Build personalized system prompt (rest stays the same)
-        personalized_prompt = SYSTEM_PROMPT + f" Target language: {target_lang}."
-        
-        # Build personalized system prompt
-        personalized_prompt = SYSTEM_PROMPT + f" Target language: {target_lang}."
-        
-        if session_feedback:
-            latest_progress = session_feedback[-1].get('feedback_data', {})
-            level = latest_progress.get('estimated_level', 'A2')
-            grammar_score = latest_progress.get('grammar_score', 5)
-            errors = latest_progress.get('errors', [])
-            
-            personalized_prompt += f"""
-            
+@app.route("/api/audio/<path:fname>")
+def get_audio(fname):
+    return send_audio(fname)
+
+TTS_CHUNK_TIMEOUT = float(os.getenv("TTS_CHUNK_TIMEOUT", "30"))
+AUDIO_STATUS_MAX_WAIT = float(os.getenv("AUDIO_STATUS_MAX_WAIT", "20"))
+
+# tts_mode="stream": the URL carries (text, lang, audio options) itself, signed so clients can't
+# have arbitrary text synthesized, which lets any worker serve it
+AUDIO_STREAM_TTL = float(os.getenv("AUDIO_STREAM_TTL", "300"))
+AUDIO_STREAM_SECRET = (os.getenv("AUDIO_STREAM_SECRET") or
+                       hashlib.sha256(f"audio-stream\n{api_key}".encode("utf-8")).hexdigest()).encode("utf-8")
+
+def _stream_signature(payload: str) -> str:
+    return hmac.new(AUDIO_STREAM_SECRET, payload.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def live_audio_token(text: str, target_lang: str, audio: dict) -> str:
+    data = json.dumps({"text": text, "lang": target_lang, "audio": audio, "exp": time.time() + AUDIO_STREAM_TTL})
+    payload = base64.urlsafe_b64encode(zlib.compress(data.encode("utf-8"))).decode("ascii").rstrip("=")
+    return f"{payload}.{_stream_signature(payload)}"
+
+def open_live_audio_token(token: str):
+    """(text, lang, audio options) from a valid, unexpired token; None otherwise"""
+    payload, _, signature = token.partition(".")
+    if not hmac.compare_digest(signature.encode("utf-8"), _stream_signature(payload).encode("utf-8")):
+        return None
+    try:
+        data = json.loads(zlib.decompress(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))))
+    except (ValueError, zlib.error):
+        return None
+    if data["exp"] < time.time():
+        return None
+    return data["text"], data["lang"], data["audio"]
+
+@app.route("/api/audio/live/<token>")
+def stream_live_audio(token):
+    """Reply audio relayed from OpenAI chunk by chunk as it is synthesized (cached copy if there is one)"""
+    entry = open_live_audio_token(token)
+    if entry is None:
+        return jsonify(error="Unknown or expired stream"), 404
+    text, target_lang, options = entry
+    chunks = tts_cache.stream(text, target_lang, join_timeout=TTS_CHUNK_TIMEOUT, **options)
+    fmt = next(chunks)  # the format actually served: a fallback tier may not have written the requested one
+    if fmt is None:
+        return jsonify(error="Audio synthesis failed"), 502
+    return Response(chunks, mimetype=MIME_TYPES.get(fmt, "application/octet-stream"),
+                    headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"})
+
+@app.route("/api/audio/status/<audio_id>")
+def get_audio_status(audio_id):
+    """pending/ready/failed for an audio_id (from any worker); ?wait=N long-polls up to N seconds while pending"""
+    playlist = tts_pipeline.get(audio_id)
+    if not playlist:
+        return jsonify(error="Unknown audio_id"), 404
+    wait = min(request.args.get("wait", 0, type=float), AUDIO_STATUS_MAX_WAIT)
+    if wait > 0:
+        playlist.wait(timeout=wait)
+    state = playlist.state()
+    audio_url, fields = None, audio_fields(None)
+    if state == "ready":
+        if len(playlist) == 1:
+            audio_url = f"/api/audio/{playlist.chunk(0)}"
+            fields = audio_fields(file_format(playlist.chunk(0)))  # a fallback tier may have written another format
+        else:
+            fields = audio_fields(playlist.options["fmt"])  # the stream carries only that format
+            fields["audio_playlist_url"] = f"/api/tts/{audio_id}"
+            if playlist.options["fmt"] in CONCAT_FORMATS:
+                audio_url = f"/api/tts/{audio_id}/stream"
+    return jsonify(audio_id=audio_id, status=state, audio_url=audio_url, **fields)
+
+@app.route("/api/tts/<playlist_id>")
+def get_tts_playlist(playlist_id):
+    """Ordered sentence chunks of a pipelined reply and their synthesis state"""
+    playlist = tts_pipeline.get(playlist_id)
+    if not playlist:
+        return jsonify(error="Unknown playlist"), 404
+    chunks = playlist.status()
+    for c in chunks:
+        c["url"] = f"/api/tts/{playlist_id}/{c['index']}"
+        c.update(audio_fields(file_format(c.pop("file"))))
+    return jsonify(id=playlist_id, chunks=chunks, complete=all(c["status"] != "pending" for c in chunks))
+
+@app.route("/api/tts/<playlist_id>/<int:index>")
+def get_tts_chunk(playlist_id, index):
+    """One sentence's audio; waits for it if it is still being synthesized"""
+    playlist = tts_pipeline.get(playlist_id)
+    if playlist is None or not 0 <= index < len(playlist):
+        return jsonify(error="Unknown chunk"), 404
+    try:
+        fname = playlist.chunk(index, timeout=TTS_CHUNK_TIMEOUT)
+    except Exception:
+        return jsonify(error="Chunk not ready"), 504
+    if not fname:
+        return jsonify(error="Synthesis failed"), 502
+    return send_audio(fname)
+
+@app.route("/api/tts/<playlist_id>/stream")
+def stream_tts_playlist(playlist_id):
+    """All chunks of a pipelined reply as one chunked audio stream, in order, as each becomes ready"""
+    playlist = tts_pipeline.get(playlist_id)
+    if not playlist:
+        return jsonify(error="Unknown playlist"), 404
+    if playlist.options["fmt"] not in CONCAT_FORMATS:
+        # e.g. Ogg Opus: joined files become chained streams most players stop reading after the first
+        return jsonify(error="Chunks of this format can't be streamed as one; play them in order",
+                       audio_playlist_url=f"/api/tts/{playlist_id}"), 409
+
+    mimetype = AUDIO_FORMATS[playlist.options["fmt"]]
+
+    def generate():
+        for i in range(len(playlist)):
+            try:
+                fname = playlist.chunk(i, timeout=TTS_CHUNK_TIMEOUT)
+            except Exception:
+                return
+            if not fname or mime_type(fname) != mimetype:
+                continue  # skip a failed (or fallback-format) sentence rather than cutting the reply short
+            audio_store.touch(fname)
+            try:
+                f = open(audio_store.path(fname), "rb")
+            except OSError:
+                continue  # evicted in the meantime
+            with f:
+                while True:
+                    block = f.read(64 * 1024)
+                    if not block:
+                        break
+                    yield block
+
+    return Response(generate(), mimetype=mimetype)
+
+def build_personalized_prompt(session_id: str, target_lang: str) -> str:
+    """Build the system prompt for a session from CACHED learner feedback"""
+    # Cache feedback data for this session (LRU + TTL, invalidated when new feedback is stored).
+    # The feedback version is shared by all workers, so a write anywhere makes this entry stale.
+    version = get_feedback_version(session_id)
+    cache_data = feedback_cache.get(session_id)
+    if cache_data is None or cache_data['version'] != version:
+        cache_data = {
+            'version': version,
+            'session_feedback': get_feedback_patterns(feedback_type="user_progress", limit=5, session_id=session_id),
+            'session_learning': get_feedback_patterns(feedback_type="learning_experience", limit=10, session_id=session_id),
+        }
+        feedback_cache.put(session_id, cache_data)
+    
+    # Use cached data
+    session_feedback = cache_data['session_feedback']
+    session_learning = cache_data['session_learning']
+    
+    # Build personalized system prompt
+    personalized_prompt = SYSTEM_PROMPT + f" Target language: {target_lang}."
+    
+    if session_feedback:
+        latest_progress = session_feedback[-1].get('feedback_data', {})
+        level = latest_progress.get('estimated_level', 'A2')
+        grammar_score = latest_progress.get('grammar_score', 5)
+        errors = latest_progress.get('errors', [])
+        
+        personalized_prompt += f"""
+        
 LEARNER PROFILE:
 - Current level: {level}
 - Grammar score: {grammar_score}/10
@@ -120,141 +289,363 @@ LEARNER PROFILE:
 - Adjust difficulty to their level
 - Focus on their weak areas
 """
-        
-        if session_learning:
-            recent_feedback = [f.get('feedback_data', {}).get('learning_feedback') for f in session_learning[-3:]]
-            if 'too_hard' in recent_feedback:
-                personalized_prompt += "\n- User finds responses too difficult - simplify language"
-            elif 'too_easy' in recent_feedback:
-                personalized_prompt += "\n- User finds responses too easy - increase complexity"
-            elif 'confused' in recent_feedback:
-                personalized_prompt += "\n- User gets confused - be more explicit and clear"
-
-            # Count feedback types for better decisions
-            feedback_counts = {}
-            for f in session_learning[-5:]:  # Last 5 feedbacks
-                fb_type = f.get('feedback_data', {}).get('learning_feedback')
-                if fb_type:
-                    feedback_counts[fb_type] = feedback_counts.get(fb_type, 0) + 1
-            
-            # More nuanced adjustments - KEEP INSIDE THE if session_learning BLOCK
-            if feedback_counts.get('too_hard', 0) >= 2:
-                personalized_prompt += "\n- User consistently finds responses too difficult - use simple vocabulary and short sentences"
-            elif feedback_counts.get('confused', 0) >= 2:
-                personalized_prompt += "\n- User gets confused frequently - provide examples and break down complex concepts"
-
-        # MOVE THIS OUTSIDE - it should always execute regardless of feedback
-        conv_manager.append(session_id, "system", personalized_prompt)
+    
+    if session_learning:
+        recent_feedback = [f.get('feedback_data', {}).get('learning_feedback') for f in session_learning[-3:]]
+        if 'too_hard' in recent_feedback:
+            personalized_prompt += "\n- User finds responses too difficult - simplify language"
+        elif 'too_easy' in recent_feedback:
+            personalized_prompt += "\n- User finds responses too easy - increase complexity"
+        elif 'confused' in recent_feedback:
+            personalized_prompt += "\n- User gets confused - be more explicit and clear"
+
+        # Count feedback types for better decisions
+        feedback_counts = {}
+        for f in session_learning[-5:]:  # Last 5 feedbacks
+            fb_type = f.get('feedback_data', {}).get('learning_feedback')
+            if fb_type:
+                feedback_counts[fb_type] = feedback_counts.get(fb_type, 0) + 1
+        
+        # More nuanced adjustments - KEEP INSIDE THE if session_learning BLOCK
+        if feedback_counts.get('too_hard', 0) >= 2:
+            personalized_prompt += "\n- User consistently finds responses too difficult - use simple vocabulary and short sentences"
+        elif feedback_counts.get('confused', 0) >= 2:
+            personalized_prompt += "\n- User gets confused frequently - provide examples and break down complex concepts"
+
+    return personalized_prompt
+
+# Bounded pool for background proficiency analysis (replaces one thread + loopback POST per turn)
+analysis_jobs = JobQueue(
+    workers=int(os.getenv("ANALYSIS_WORKERS", "4")),
+    max_queue=int(os.getenv("ANALYSIS_MAX_QUEUE", "1000")),
+    name="analysis",
+)
+
+# Coalesces a session's user messages into one analysis call (K messages / T seconds / idle)
+analysis_aggregator = AnalysisAggregator(
+    lambda sid, msgs, lang: analysis_jobs.submit("analyze_user", run_batch_analysis, sid, msgs, lang,
+                                                 priority=PRIORITY_LOW),
+    max_messages=int(os.getenv("ANALYSIS_BATCH_MESSAGES", "5")),
+    max_wait=float(os.getenv("ANALYSIS_BATCH_WAIT", "30")),
+    idle_after=float(os.getenv("ANALYSIS_IDLE_FLUSH", "10")),
+)
+# atexit runs in reverse: flush buffered messages first, then drain the job pool
+atexit.register(analysis_jobs.close)
+atexit.register(analysis_aggregator.flush_all)
+
+def summarize_turns(previous_summary: str, turns: list) -> str:
+    """Fold older conversation turns into the rolling session summary"""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in turns)
+    summary_prompt = f"""
+    Update this summary of a language-practice conversation with the new turns below.
+    Keep the learner's topics, personal details, recurring mistakes and level. Max 120 words.
+    
+    Current summary: {previous_summary or "(none)"}
+    
+    New turns:
+    {transcript}
+    """
+    summary = chat_breaker.call(
+        client.chat.completions.create,
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": summary_prompt}],
+        max_tokens=200
+    )
+    return summary.choices[0].message.content.strip()
+
+context_builder = ContextBuilder(
+    summarize_turns,
+    lambda fn: analysis_jobs.submit("summarize", fn, priority=PRIORITY_NORMAL),
+    token_budget=int(os.getenv("PROMPT_TOKEN_BUDGET", "1500")),
+    keep_turns=int(os.getenv("PROMPT_KEEP_TURNS", "6")),
+)
+
+# Whole-turn budget (seconds) shared by every outbound call, and per-stage caps within it
+CONVERSE_DEADLINE = float(os.getenv("CONVERSE_DEADLINE", "10"))
+CHAT_TIMEOUT = float(os.getenv("CHAT_TIMEOUT", "8"))
+TTS_MIN_BUDGET = float(os.getenv("TTS_MIN_BUDGET", "2"))  # blocking TTS needs at least this much left
+converse_stages = StagedExecutor(
+    max_workers=int(os.getenv("CONVERSE_STAGE_WORKERS", "16")),
+    background_workers=int(os.getenv("CONVERSE_BACKGROUND_WORKERS", "8")),
+    timeouts={
+        "personalize": float(os.getenv("PERSONALIZE_TIMEOUT", "3.0")),
+        "contextual_feedback": float(os.getenv("CONTEXT_FEEDBACK_TIMEOUT", "2.0")),
+    },
+)
+
+PROMPT_FALLBACK = "fallback"  # system_meta of a generic prompt pinned because personalization failed
+
+def prepare_turn(session_id: str, user_text: str, target_lang: str):
+    """Everything that has to happen before the completion; returns (stages, context)"""
+    # Only personalization + contextual feedback gate the completion; persisting
+    # the user message runs in the background alongside them.
+    stages = converse_stages.run(Deadline(CONVERSE_DEADLINE))
+    # Optional: skipped outright while Pinecone's breaker is open
+    feedback_stage = stages.submit("contextual_feedback", get_contextual_feedback, session_id, user_text,
+                                   stages.deadline, breaker=pinecone_breaker)
+    stages.background("store_user", store_message, session_id, "user", user_text)
+
+    # Per-session lock (cross-worker with a shared store) so two turns can't both seed the prompt
+    with conv_manager.lock(session_id):
+        # The pinned prompt is tagged with the feedback version it was built from: rebuild it once
+        # new feedback or progress has been stored, or if the last build fell back to the generic one
+        version = str(get_feedback_version(session_id))
+        if conv_manager.system_meta(session_id) != version:
+            personalize = stages.submit("personalize", build_personalized_prompt, session_id, target_lang)
+            prompt = personalize.result()
+            if prompt is not None:
+                conv_manager.append(session_id, "system", prompt, meta=version)
+            elif not conv_manager.get_history(session_id):
+                fallback_prompt = SYSTEM_PROMPT + f" Target language: {target_lang}."
+                conv_manager.append(session_id, "system", fallback_prompt, meta=PROMPT_FALLBACK)
+
+        # User message
+        conv_manager.append(session_id, "user", user_text)
 
-    # User message
-    conv_manager.append(session_id, "user", user_text)
-    try:
-        store_message(session_id, "user", user_text)
-    except Exception as e:
-        print("Store user error:", e)
+        messages = conv_manager.get_history(session_id)
+    contextual_feedback = feedback_stage.result(default=[])
 
-    messages = conv_manager.get_history(session_id)
-    contextual_feedback = get_contextual_feedback(session_id, user_text)
-        
+    hints = []
     if contextual_feedback:
         recent_similar_feedback = [f.get('feedback_data', {}).get('learning_feedback') for f in contextual_feedback[-3:]]
         if 'too_hard' in recent_similar_feedback:
-            messages.append({"role": "system", "content": "For similar topics, user found responses too difficult. Simplify language."})
+            hints.append({"role": "system", "content": "For similar topics, user found responses too difficult. Simplify language."})
         elif 'confused' in recent_similar_feedback:
-            messages.append({"role": "system", "content": "For similar topics, user was confused. Be extra clear and provide examples."})
+            hints.append({"role": "system", "content": "For similar topics, user was confused. Be extra clear and provide examples."})
+
+    # Fit history into the token budget (older turns folded into a rolling summary)
+    context = context_builder.build(session_id, messages, extra=hints)
+    return stages, context
+
+def finish_turn(stages, session_id: str, user_text: str, reply: str, target_lang: str):
+    """Record the reply; persistence and analysis never block the response"""
+    # Store messages (vector persistence never blocks the reply)
+    with conv_manager.lock(session_id):
+        conv_manager.append(session_id, "assistant", reply)
+    stages.background("store_assistant", store_message, session_id, "assistant", reply)
+
+    # Background proficiency analysis: buffered per session, analyzed in batches on the job pool
+    analysis_aggregator.add(session_id, user_text, target_lang)
+
+def synthesize_reply(reply: str, target_lang: str, audio: dict, deadline: Deadline = None):
+    """TTS for a whole reply (content-addressed cache first); returns the audio filename or None"""
+    return render_tts(reply, target_lang, deadline=deadline, **audio)
+
+def reply_audio(reply: str, target_lang: str, tts: bool, tts_mode: str, audio: dict, stages) -> dict:
+    """Audio fields for a converse response; audio holds the negotiated fmt/quality"""
+    if not tts:
+        return {"audio_url": None}
+    if tts_mode == "full" and stages.deadline.remaining() < TTS_MIN_BUDGET:
+        # Not enough of the turn budget left to block on TTS: hand out an async handle instead
+        stages.skip("tts_full", "deadline exceeded")
+        tts_mode = "async"
+    # audio_format / audio_mime_type describe the audio actually served, which differs from the
+    # requested format when a fallback tier produced it; None until that is known
+    fields = {"requested_audio_format": audio["fmt"]}
+    if tts_mode == "sentences":
+        # Pipelined: returns at once; the stream URL plays sentence 1 while the rest synthesize
+        playlist = tts_pipeline.start(reply, target_lang, **audio)
+        streamable = audio["fmt"] in CONCAT_FORMATS  # otherwise the client plays the chunks in order
+        return {
+            **fields,
+            **audio_fields(audio["fmt"]),  # the stream skips sentences in any other format
+            "audio_id": playlist.id,
+            "audio_url": f"/api/tts/{playlist.id}/stream" if streamable else None,
+            "audio_playlist_url": f"/api/tts/{playlist.id}",
+        }
+    if tts_mode == "stream":
+        # No disk round-trip before playback: the URL relays TTS bytes as they arrive
+        token = live_audio_token(reply, target_lang, audio)
+        # The format is only settled once the URL is fetched: its Content-Type reports it
+        return {**fields, **audio_fields(None), "audio_url": f"/api/audio/live/{token}"}
+    if tts_mode == "full":
+        # Every TTS tier together gets only what is left of the turn deadline
+        audio_filename = synthesize_reply(reply, target_lang, audio, stages.deadline)
+        return {**fields, **audio_fields(file_format(audio_filename)),
+                "audio_url": f"/api/audio/{audio_filename}" if audio_filename else None}
+    # Default (async): the text goes out now; audio is synthesized on the TTS pool
+    playlist = tts_pipeline.start(reply, target_lang, split=False, **audio)
+    ready = playlist.chunk(0) if playlist.state() == "ready" else None  # cache hits are instant
+    return {
+        **fields,
+        **audio_fields(file_format(ready)),
+        "audio_id": playlist.id,
+        "audio_status": playlist.state(),
+        "audio_status_url": f"/api/audio/status/{playlist.id}",
+        "audio_url": f"/api/audio/{ready}" if ready else None,
+    }
+
+def _chat_completion(messages: list, deadline: Deadline, stream: bool = False):
+    """Reply completion within what is left of the turn deadline; fast-fails while the breaker is open.
+
+    A stream's outcome is only known once it has been read, so for stream=True the caller
+    records success or failure on chat_breaker (a failure to open the stream is recorded here).
+    """
+    timeout = deadline.timeout(CHAT_TIMEOUT)
+    if timeout <= 0:
+        raise TimeoutError("request deadline exceeded before the completion")
+    create = functools.partial(
+        client.with_options(timeout=timeout, max_retries=0).chat.completions.create,
+        model="gpt-4o-mini",  # Much faster than gpt-5 (~0.5s vs 2s)
+        messages=messages,
+        max_tokens=150,  # Limit response length for speed
+        temperature=0.7,  # Slightly lower for consistency
+        stream=stream
+    )
+    if not stream:
+        return chat_breaker.call(create)
+    if not chat_breaker.allow():
+        raise CircuitOpenError(f"{chat_breaker.name} circuit open")
+    try:
+        return create()
+    except Exception:
+        chat_breaker.record_failure()
+        raise
+
+# Accept header -> audio format, for clients that negotiate over HTTP instead of the body
+_ACCEPT_FORMATS = {"audio/ogg": "opus", "audio/opus": "opus", "audio/webm": "opus",
+                   "audio/aac": "aac", "audio/mp4": "aac", "audio/pcm": "pcm", "audio/l16": "pcm",
+                   "audio/mpeg": "mp3"}
+
+def _accepted_audio_format(accept: str):
+    """Format of the audio type with the highest q-value in an Accept header (ties: first listed)"""
+    best, best_q = None, 0.0
+    for item in accept.split(","):
+        mime, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        fmt = _ACCEPT_FORMATS.get(mime.lower())
+        if fmt and q > best_q:
+            best, best_q = fmt, q
+    return best
+
+def negotiate_audio(data: dict) -> dict:
+    """Audio format/quality for this request: body fields win, then the Accept header, then defaults"""
+    fmt = data.get("audio_format")
+    if not fmt:
+        fmt = _accepted_audio_format(request.headers.get("Accept", ""))
+    fmt, quality = audio_options(fmt, data.get("audio_quality"))  # quality: "fast" | "hd"
+    return {"fmt": fmt, "quality": quality}
+
+def _parse_converse_request():
+    data = request.get_json(force=True)
+    user_text = data.get("text", "").strip()
+    target_lang = data.get("lang", "en")
+    session_id = data.get("session_id") or "default"
+    tts = bool(data.get("tts", True))
+    tts_mode = data.get("tts_mode", "async")  # "async" | "stream" | "sentences" | "full" (blocking)
+    return user_text, target_lang, session_id, tts, tts_mode, negotiate_audio(data)
+
+@app.route("/api/converse", methods=["POST"])
+def converse():
+    user_text, target_lang, session_id, tts, tts_mode, audio = _parse_converse_request()
+
+    if not user_text:
+        return jsonify(error="Empty text"), 400
+
+    stages, context = prepare_turn(session_id, user_text, target_lang)
 
     try:
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",  # Much faster than gpt-5 (~0.5s vs 2s)
-            messages=messages,
-            max_tokens=150,  # Limit response length for speed
-            temperature=0.7  # Slightly lower for consistency   
-        )
-        
+        completion = _chat_completion(context["messages"], stages.deadline)
         reply = completion.choices[0].message.content.strip()
-        # Remove the streaming loop - just get reply directly
+    except CircuitOpenError as e:
+        return jsonify(error=str(e), skipped_stages=stages.skipped()), 503
     except Exception as e:
         print("OpenAI error:", e)
         return jsonify(error=str(e)), 500
     
-    # Store messages
-    conv_manager.append(session_id, "assistant", reply)
-    try:
-        store_message(session_id, "assistant", reply)
-    except Exception as e:
-        print("Store assistant error:", e)
-
-    # Background analysis of BOTH messages
-    def background_analysis():
-        try:
-            # Only analyze user's language proficiency (not AI quality)
-            user_analysis_data = {
-                "user_message": user_text,
-                "session_id": session_id,
-                "target_lang": target_lang
-            }
-            requests.post("http://localhost:8000/api/analyze/user", 
-                            json=user_analysis_data, timeout=5)
-        except:
-            pass  # Silent fail
-
-    threading.Thread(target=background_analysis, daemon=True).start()
-
-    audio_filename = None
-    if tts:
-        try:
-            # Use OpenAI TTS instead of gTTS for more natural voice
-            audio_filename = f"{uuid.uuid4().hex}.mp3"
-            audio_path = os.path.join(AUDIO_DIR, audio_filename)
-            
-            # OpenAI TTS with Russell-appropriate male voice
-            response = client.audio.speech.create(
-                model="tts-1-hd",  # Higher quality for better sound
-                voice="alloy",     # Changed to male voice - options: alloy (neutral male), echo (clear male), onyx (deep male)
-                input=reply,
-                speed=1.1          # Slightly faster for Russell's energetic personality
-            )
-            
-            response.stream_to_file(audio_path)
-            
-        except Exception as e:
-            print("OpenAI TTS error:", e)
-            # Fallback to gTTS
-            try:
-                tts_lang = target_lang.split('-')[0]
-                tts_obj = gTTS(reply, lang=tts_lang, slow=False)
-                tts_obj.save(audio_path)
-            except:
-                audio_filename = None
+    finish_turn(stages, session_id, user_text, reply, target_lang)
+    reply_audio_fields = reply_audio(reply, target_lang, tts, tts_mode, audio, stages)
 
-    # ADD THIS RETURN STATEMENT:
     return jsonify(
         session_id=session_id,
         reply=reply,
-        audio_url=f"/api/audio/{audio_filename}" if audio_filename else None
+        prompt_tokens=context["prompt_tokens"],
+        prompt_tokens_saved=context["saved_tokens"],
+        skipped_stages=stages.skipped(),
+        **reply_audio_fields
     )
 
-def get_contextual_feedback(session_id: str, user_message: str):
-    """Get relevant feedback for similar past interactions"""
-    try:
-        # Search for similar conversations
-        similar_interactions = semantic_search(session_id, user_message, top_k=5)
-        
-        # Get feedback for those interactions
-        relevant_feedback = []
-        for interaction in similar_interactions:
-            # Find feedback for this type of conversation
-            feedback = get_feedback_patterns(feedback_type="learning_experience", limit=20)
-            for f in feedback:
-                if f.get('session_id') == session_id:
-                    ai_response = f.get('feedback_data', {}).get('ai_response', '')
-                    if ai_response in [i.get('content', '') for i in similar_interactions]:
-                        relevant_feedback.append(f)
-        
-        return relevant_feedback
-    except:
+def _sse(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@app.route("/api/converse/stream", methods=["POST"])
+def converse_stream():
+    """Same as /api/converse, but relays the reply as Server-Sent Events while it is generated"""
+    user_text, target_lang, session_id, tts, tts_mode, audio = _parse_converse_request()
+
+    if not user_text:
+        return jsonify(error="Empty text"), 400
+
+    stages, context = prepare_turn(session_id, user_text, target_lang)
+
+    def generate():
+        parts = []
+        finished = False
+        try:
+            try:
+                response = _chat_completion(context["messages"], stages.deadline, stream=True)
+            except Exception as e:
+                print("OpenAI stream error:", e)
+                yield _sse("error", {"error": str(e), "skipped_stages": stages.skipped()})
+                return
+            try:
+                for chunk in response:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        parts.append(delta)
+                        yield _sse("delta", {"text": delta})
+            except Exception as e:
+                chat_breaker.record_failure()
+                print("OpenAI stream error:", e)
+                yield _sse("error", {"error": str(e), "skipped_stages": stages.skipped()})
+                return
+            chat_breaker.record_success()
+
+            reply = "".join(parts).strip()
+            finish_turn(stages, session_id, user_text, reply, target_lang)
+            finished = True
+            reply_audio_fields = reply_audio(reply, target_lang, tts, tts_mode, audio, stages)
+            yield _sse("done", {
+                "session_id": session_id,
+                "reply": reply,
+                "prompt_tokens": context["prompt_tokens"],
+                "prompt_tokens_saved": context["saved_tokens"],
+                "skipped_stages": stages.skipped(),
+                **reply_audio_fields,
+            })
+        finally:
+            # Also runs when the client disconnects mid-stream (the upstream outcome is then left
+            # unrecorded): what arrived is still stored and analyzed, so the user turn is answered
+            if not finished and parts:
+                finish_turn(stages, session_id, user_text, "".join(parts).strip(), target_lang)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def get_contextual_feedback(session_id: str, user_message: str, deadline: Deadline = None):
+    """Get relevant feedback for similar past interactions.
+
+    Failures and timeouts propagate, so the contextual_feedback stage reports them in skipped_stages.
+    """
+    # Search for similar conversations
+    similar_interactions = semantic_search(session_id, user_message, top_k=5, deadline=deadline, strict=True)
+    if not similar_interactions:
         return []
 
+    # One hashed lookup per similar interaction against the session's feedback index
+    feedback_by_response = get_learning_feedback_index(session_id)
+    relevant_feedback = []
+    for content in dict.fromkeys(i.get('content', '') for i in similar_interactions):
+        relevant_feedback.extend(feedback_by_response.get(content, []))
+
+    return relevant_feedback
+
 
 @app.route("/api/search", methods=["GET"])
 def search():
@@ -427,6 +818,102 @@ def get_analytics(session_id):
 #     except Exception as e:
 #         return jsonify(error=str(e)), 500
     
+def analyze_user_message(session_id: str, user_message: str, target_lang: str = "en") -> str:
+    """Ask the model for a proficiency assessment of one user message (raw JSON text)"""
+    # Analyze user's language skills
+    user_analysis_prompt = f"""
+    Analyze this language learner's message for proficiency assessment:
+    
+    Target language: {target_lang}
+    User message: "{user_message}"
+    
+    Evaluate and return JSON:
+    {{
+        "grammar_score": 0-10,
+        "vocabulary_level": "beginner|intermediate|advanced",
+        "fluency_indicators": ["natural phrases used", "complex structures"],
+        "errors": [
+            {{"type": "grammar", "error": "specific mistake", "correction": "suggested fix"}},
+            {{"type": "vocabulary", "error": "word choice", "suggestion": "better word"}}
+        ],
+        "strengths": ["what they did well"],
+        "focus_areas": ["what to practice next"],
+        "estimated_level": "A1|A2|B1|B2|C1|C2"
+    }}
+    """
+    
+    analysis = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": user_analysis_prompt}]
+    )
+    return analysis.choices[0].message.content
+
+def store_user_progress(session_id: str, analysis_text: str):
+    """Parse a proficiency assessment and store it as user_progress feedback"""
+    try:
+        response_text = analysis_text.strip()
+        
+        # Handle cases where GPT doesn't return valid JSON
+        if not response_text.startswith('{'):
+            print(f"Invalid JSON response: {response_text[:100]}...")
+            return
+        
+        progress_data = json.loads(response_text)
+        store_feedback(session_id, f"user-{int(time.time()*1000)}", "user_progress", progress_data)
+        print(f"[User Progress] Stored analysis for session {session_id}")
+        
+    except json.JSONDecodeError as e:
+        print(f"JSON parsing error: {e}")
+        print(f"Response was: {analysis_text[:200]}...")
+    except Exception as e:
+        print("Store user progress error:", e)
+
+def analyze_user_messages(user_messages: list, target_lang: str = "en") -> list:
+    """One structured-output call assessing several user messages; one result per message"""
+    numbered = "\n".join(f'{i + 1}. "{m}"' for i, m in enumerate(user_messages))
+    batch_prompt = f"""
+    Analyze each of these language learner's messages separately for proficiency assessment:
+    
+    Target language: {target_lang}
+    User messages:
+    {numbered}
+    
+    Return JSON {{"analyses": [...]}} with exactly {len(user_messages)} entries, in the same order, each:
+    {{
+        "grammar_score": 0-10,
+        "vocabulary_level": "beginner|intermediate|advanced",
+        "fluency_indicators": ["natural phrases used", "complex structures"],
+        "errors": [
+            {{"type": "grammar", "error": "specific mistake", "correction": "suggested fix"}},
+            {{"type": "vocabulary", "error": "word choice", "suggestion": "better word"}}
+        ],
+        "strengths": ["what they did well"],
+        "focus_areas": ["what to practice next"],
+        "estimated_level": "A1|A2|B1|B2|C1|C2"
+    }}
+    """
+    
+    analysis = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": batch_prompt}],
+        response_format={"type": "json_object"}
+    )
+    analyses = json.loads(analysis.choices[0].message.content).get("analyses", [])
+    return [a if isinstance(a, dict) else {} for a in analyses]
+
+def run_batch_analysis(session_id: str, user_messages: list, target_lang: str = "en"):
+    """Background job: analyze a session's buffered messages and store one user_progress record each"""
+    analyses = analyze_user_messages(user_messages, target_lang)
+    if len(analyses) != len(user_messages):
+        print(f"[User Progress] expected {len(user_messages)} analyses, got {len(analyses)}")
+    items = []
+    for i, (message, progress_data) in enumerate(zip(user_messages, analyses)):
+        if progress_data:
+            progress_data["user_message"] = message
+            items.append((f"user-{int(time.time()*1000)}-{i}", progress_data))
+    store_feedback_batch(session_id, "user_progress", items)
+    print(f"[User Progress] Stored {len(items)} analyses for session {session_id}")
+
 @app.route("/api/analyze/user", methods=["POST"])
 def analyze_user_response():
     """Analyze user's language proficiency and progress"""
@@ -436,110 +923,48 @@ def analyze_user_response():
     target_lang = data.get("target_lang", "en")
     
     try:
-        # Analyze user's language skills
-        user_analysis_prompt = f"""
-        Analyze this language learner's message for proficiency assessment:
-        
-        Target language: {target_lang}
-        User message: "{user_message}"
-        
-        Evaluate and return JSON:
-        {{
-            "grammar_score": 0-10,
-            "vocabulary_level": "beginner|intermediate|advanced",
-            "fluency_indicators": ["natural phrases used", "complex structures"],
-            "errors": [
-                {{"type": "grammar", "error": "specific mistake", "correction": "suggested fix"}},
-                {{"type": "vocabulary", "error": "word choice", "suggestion": "better word"}}
-            ],
-            "strengths": ["what they did well"],
-            "focus_areas": ["what to practice next"],
-            "estimated_level": "A1|A2|B1|B2|C1|C2"
-        }}
-        """
-        
-        analysis = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": user_analysis_prompt}]
-        )
+        analysis_text = analyze_user_message(session_id, user_message, target_lang)
         
         # Store user progress data
-        def store_user_progress():
-            try:
-                import json
-                response_text = analysis.choices[0].message.content.strip()
-                
-                # Handle cases where GPT doesn't return valid JSON
-                if not response_text.startswith('{'):
-                    print(f"Invalid JSON response: {response_text[:100]}...")
-                    return
-                
-                progress_data = json.loads(response_text)
-                store_feedback(session_id, f"user-{int(time.time()*1000)}", "user_progress", progress_data)
-                print(f"[User Progress] Stored analysis for session {session_id}")
-                
-            except json.JSONDecodeError as e:
-                print(f"JSON parsing error: {e}")
-                print(f"Response was: {analysis.choices[0].message.content[:200]}...")
-            except Exception as e:
-                print("Store user progress error:", e)
-        
-        threading.Thread(target=store_user_progress, daemon=True).start()
+        analysis_jobs.submit("store_user_progress", store_user_progress, session_id, analysis_text,
+                             priority=PRIORITY_NORMAL)
         
-        return jsonify(analysis=analysis.choices[0].message.content)
+        return jsonify(analysis=analysis_text)
         
     except Exception as e:
         return jsonify(error=str(e)), 500
 
 @app.route("/api/progress/<session_id>", methods=["GET"])
 def get_user_progress(session_id):
-    """Track user's learning progress over time"""
+    """Track user's learning progress over time (reads the incrementally maintained rollup)"""
     try:
-        # Get user progress feedback
-        user_feedback = [f for f in get_feedback_patterns(feedback_type="user_progress", limit=50) 
-                        if f.get('session_id') == session_id]
+        version, rollup = get_progress_rollup(session_id)
         
-        if not user_feedback:
+        if not rollup:
             return jsonify(
                 session_id=session_id,
                 total_messages_analyzed=0,
                 message="No progress data yet"
             )
         
-        # Calculate progress trends (with safe defaults)
-        grammar_scores = []
-        levels = []
-        all_errors = []
+        # Cheap polling: the rollup version changes whenever a user_progress record is stored
+        etag = f'"{session_id}-{version}"'
+        if etag in request.headers.get("If-None-Match", ""):
+            return "", 304, {"ETag": etag}
         
-        for f in user_feedback:
-            feedback_data = f.get('feedback_data', {})
-            
-            # Safely extract grammar score
-            if 'grammar_score' in feedback_data:
-                grammar_scores.append(feedback_data['grammar_score'])
-                
-            # Safely extract level
-            if 'estimated_level' in feedback_data:
-                levels.append(feedback_data['estimated_level'])
-                
-            # Safely extract errors
-            errors = feedback_data.get('errors', [])
-            all_errors.extend([err.get('type', 'unknown') for err in errors if isinstance(err, dict)])
-        
-        # Count error patterns
-        error_patterns = {}
-        for error_type in all_errors:
-            error_patterns[error_type] = error_patterns.get(error_type, 0) + 1
-        
-        return jsonify(
+        levels = rollup["level_progression"]
+        response = jsonify(
             session_id=session_id,
-            total_messages_analyzed=len(user_feedback),
-            grammar_trend=grammar_scores,
+            total_messages_analyzed=rollup["count"],
+            grammar_trend=rollup["grammar_trend"],
             current_level=levels[-1] if levels else "Not assessed",
             level_progression=levels,
-            common_error_types=sorted(error_patterns.items(), key=lambda x: x[1], reverse=True),
-            avg_grammar_score=sum(grammar_scores) / len(grammar_scores) if grammar_scores else None
+            common_error_types=sorted(rollup["error_counts"].items(), key=lambda x: x[1], reverse=True),
+            avg_grammar_score=rollup["grammar_sum"] / rollup["grammar_count"] if rollup["grammar_count"] else None,
+            messages_per_day=rollup["per_day"]
         )
+        response.headers["ETag"] = etag
+        return response
         
     except Exception as e:
         return jsonify(error=str(e)), 500
@@ -0,0 +1,528 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from gtts import gTTS
+from openai import OpenAI
+from dotenv import load_dotenv
+
+from audio_store import AudioStore
+from circuit_breaker import breaker_from_env
+from pipeline import Deadline
+from tts_pipeline import split_sentences
+load_dotenv(override=True)
+
+# Text-to-speech in tiers: OpenAI TTS, then gTTS, then an offline local synthesizer
+# (espeak-ng/espeak, if installed). Each tier sits behind a circuit breaker so an
+# outage is skipped quickly instead of costing every request a slow failure.
+# Output goes to a content-addressed file cache, so repeated phrases cost zero
+# TTS calls and zero new files.
+# Whole replies are cached per sentence (per voice/language/format) and stitched
+# together, so the stock phrases Russell repeats are synthesized once.
+TTS_MODEL = os.getenv("TTS_MODEL", "tts-1-hd")  # Higher quality for better sound
+TTS_FAST_MODEL = os.getenv("TTS_FAST_MODEL", "tts-1")  # Lower latency, for quality="fast"
+TTS_VOICE = os.getenv("TTS_VOICE", "alloy")     # options: alloy (neutral male), echo (clear male), onyx (deep male)
+TTS_SPEED = float(os.getenv("TTS_SPEED", "1.1"))  # Slightly faster for Russell's energetic personality
+
+# Negotiable output formats -> MIME type of the served file. OpenAI "opus" is Ogg Opus,
+# "aac" is ADTS and "pcm" is raw 16-bit little-endian mono at 24 kHz.
+AUDIO_FORMATS = {
+    "mp3": "audio/mpeg",
+    "opus": "audio/ogg",
+    "aac": "audio/aac",
+    "pcm": "audio/pcm;rate=24000",
+}
+# Formats whose files play back to back when simply concatenated (MP3 and ADTS frames, raw
+# PCM). Ogg Opus files would become chained streams that many decoders stop reading after
+# the first link, so opus is remuxed with ffmpeg or synthesized whole instead.
+CONCAT_FORMATS = {"mp3", "aac", "pcm"}
+# Every format a served file may have: the local engine's wav is only ever a fallback file,
+# never negotiated (WAV headers don't survive sentence stitching)
+MIME_TYPES = {**AUDIO_FORMATS, "wav": "audio/wav"}
+QUALITY_MODELS = {"fast": TTS_FAST_MODEL, "hd": TTS_MODEL}
+AUDIO_FORMAT = os.getenv("AUDIO_FORMAT", "mp3")  # used when a request doesn't ask for one
+if AUDIO_FORMAT not in AUDIO_FORMATS:
+    AUDIO_FORMAT = "mp3"
+TTS_QUALITY = os.getenv("TTS_QUALITY", "hd")
+
+# gTTS only writes mp3 and the local engine wav; ffmpeg (if installed) converts
+# fallback audio to the requested format
+FFMPEG = shutil.which("ffmpeg")
+_FFMPEG_ARGS = {
+    "mp3": ["-c:a", "libmp3lame", "-b:a", "64k", "-f", "mp3"],
+    "opus": ["-c:a", "libopus", "-b:a", "32k", "-f", "ogg"],
+    "aac": ["-c:a", "aac", "-b:a", "48k", "-f", "adts"],
+    "pcm": ["-ar", "24000", "-ac", "1", "-f", "s16le"],
+}
+
+AUDIO_DIR = os.path.join(os.path.dirname(__file__), "tts_out")
+audio_store = AudioStore(
+    AUDIO_DIR,
+    max_bytes=int(os.getenv("AUDIO_MAX_BYTES", str(1024 * 1024 * 1024))),
+    sweep_interval=float(os.getenv("AUDIO_SWEEP_INTERVAL", "60")),
+    min_age=float(os.getenv("AUDIO_MIN_AGE", "300")),
+)
+
+# Offline tier: optional, needs no network
+LOCAL_TTS = shutil.which("espeak-ng") or shutil.which("espeak")
+
+# Bounded per-tier latency: no 10-minute default timeout and no stacked retries
+OPENAI_TTS_TIMEOUT = float(os.getenv("TTS_OPENAI_TIMEOUT", "15"))
+_openai = OpenAI(timeout=OPENAI_TTS_TIMEOUT, max_retries=int(os.getenv("TTS_OPENAI_RETRIES", "0")))
+GTTS_TIMEOUT = float(os.getenv("TTS_GTTS_TIMEOUT", "10"))
+LOCAL_TTS_TIMEOUT = float(os.getenv("TTS_LOCAL_TIMEOUT", "10"))
+
+
+def audio_options(fmt: Optional[str] = None, quality: Optional[str] = None) -> Tuple[str, str]:
+    """Validated (format, quality), falling back to the server defaults"""
+    fmt = (fmt or "").lower()
+    quality = (quality or "").lower()
+    return (fmt if fmt in AUDIO_FORMATS else AUDIO_FORMAT,
+            quality if quality in QUALITY_MODELS else TTS_QUALITY)
+
+
+def file_format(fname: Optional[str]) -> Optional[str]:
+    """Format of an audio file, from its extension (None for no file)"""
+    return fname.rsplit(".", 1)[-1] if fname else None
+
+
+def mime_type(fname: str) -> str:
+    return MIME_TYPES.get(file_format(fname), "application/octet-stream")
+
+
+def _openai_to_file(text: str, target_lang: str, path: str, fmt: str, quality: str,
+                    timeout: float = OPENAI_TTS_TIMEOUT) -> str:
+    # OpenAI TTS with Russell-appropriate male voice
+    response = _openai.with_options(timeout=timeout).audio.speech.create(
+        model=QUALITY_MODELS[quality],
+        voice=TTS_VOICE,
+        input=text,
+        speed=TTS_SPEED,
+        response_format=fmt,
+    )
+    response.stream_to_file(path)
+    return fmt
+
+
+def _gtts_to_file(text: str, target_lang: str, path: str, fmt: str, quality: str,
+                  timeout: float = GTTS_TIMEOUT) -> str:
+    tts_lang = target_lang.split('-')[0]
+    gTTS(text, lang=tts_lang, slow=False, timeout=timeout).save(path)
+    return _convert(path, "mp3", fmt)
+
+
+def _local_to_file(text: str, target_lang: str, path: str, fmt: str, quality: str,
+                   timeout: float = LOCAL_TTS_TIMEOUT) -> str:
+    subprocess.run([LOCAL_TTS, "-v", target_lang.split('-')[0], "-w", path, text],
+                   check=True, timeout=timeout, capture_output=True)
+    return _convert(path, "wav", fmt)
+
+
+def _convert(path: str, written: str, fmt: str) -> str:
+    """Format of the file at path after trying to convert it from written to fmt"""
+    if fmt != written and _transcode(path, fmt):
+        return fmt
+    return written
+
+
+# (engine, writer) in order of preference; each writer returns the format it wrote
+TTS_TIERS = [("openai", _openai_to_file), ("gtts", _gtts_to_file)]
+if LOCAL_TTS:
+    TTS_TIERS.append(("local", _local_to_file))
+TIER_TIMEOUTS = {"openai": OPENAI_TTS_TIMEOUT, "gtts": GTTS_TIMEOUT, "local": LOCAL_TTS_TIMEOUT}
+
+tts_breakers = {name: breaker_from_env(f"tts_{name}", "TTS_BREAKER") for name, _ in TTS_TIERS}
+
+
+def synthesize_to_file(text: str, target_lang: str, path: str, fmt: str = AUDIO_FORMAT,
+                       quality: str = TTS_QUALITY, tiers=None, deadline: Deadline = None) -> Optional[Tuple[str, str]]:
+    """Write speech for text to path; returns (engine, format written), or None if all tiers failed.
+
+    A deadline caps all tiers together: each gets what is left of it, at most its own timeout.
+    """
+    for engine, write in (TTS_TIERS if tiers is None else tiers):
+        timeout = TIER_TIMEOUTS[engine] if deadline is None else deadline.timeout(TIER_TIMEOUTS[engine])
+        if timeout <= 0:
+            print("TTS skipped: deadline exceeded")
+            return None
+        breaker = tts_breakers[engine]
+        if not breaker.allow():
+            continue  # tripped: skip without waiting on it
+        try:
+            written = write(text, target_lang, path, fmt, quality, timeout)
+        except Exception as e:
+            breaker.record_failure()
+            print(f"{engine} TTS error:", e)
+            continue
+        breaker.record_success()
+        return engine, written
+    return None
+
+
+def fallback_to_file(text: str, target_lang: str, path: str, fmt: str = AUDIO_FORMAT,
+                     quality: str = TTS_QUALITY) -> Optional[Tuple[str, str]]:
+    """Every tier after OpenAI (used once the OpenAI stream has failed)"""
+    return synthesize_to_file(text, target_lang, path, fmt, quality, tiers=TTS_TIERS[1:])
+
+
+def breaker_stats() -> dict:
+    return {engine: breaker.stats() for engine, breaker in tts_breakers.items()}
+
+
+def _remux(paths: List[str], out: str, fmt: str) -> bool:
+    """Join same-format files into one stream at out with ffmpeg's concat demuxer (no re-encode)"""
+    if not FFMPEG or fmt not in _FFMPEG_ARGS:
+        return False
+    listing = f"{out}.txt"
+    try:
+        with open(listing, "w") as f:
+            for path in paths:
+                escaped = path.replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        subprocess.run([FFMPEG, "-loglevel", "error", "-y", "-f", "concat", "-safe", "0", "-i", listing,
+                        "-c", "copy", "-f", _FFMPEG_ARGS[fmt][-1], out], check=True, timeout=30)
+        return True
+    except Exception as e:
+        print("ffmpeg concat error:", e)
+        return False
+    finally:
+        if os.path.exists(listing):
+            os.remove(listing)
+
+
+def joinable(fmt: str) -> bool:
+    """Whether per-sentence files of fmt can be joined into one playable file"""
+    return fmt in CONCAT_FORMATS or (FFMPEG is not None and fmt in _FFMPEG_ARGS)
+
+
+def _transcode(path: str, fmt: str) -> bool:
+    if not FFMPEG or fmt not in _FFMPEG_ARGS:
+        return False
+    out = f"{path}.{fmt}"
+    try:
+        subprocess.run([FFMPEG, "-loglevel", "error", "-y", "-i", path, *_FFMPEG_ARGS[fmt], out],
+                       check=True, timeout=30)
+        os.replace(out, path)
+        return True
+    except Exception as e:
+        print("ffmpeg error:", e)
+        return False
+    finally:
+        if os.path.exists(out):
+            os.remove(out)
+
+
+def stream_speech(text: str, chunk_size: int, fmt: str = AUDIO_FORMAT,
+                  quality: str = TTS_QUALITY) -> Iterator[bytes]:
+    """OpenAI speech bytes as they arrive over HTTP, without buffering the whole file"""
+    with _openai.audio.speech.with_streaming_response.create(
+        model=QUALITY_MODELS[quality],
+        voice=TTS_VOICE,
+        input=text,
+        speed=TTS_SPEED,
+        response_format=fmt,
+    ) as response:
+        yield from response.iter_bytes(chunk_size)
+
+
+def audio_key(text: str, engine: str, lang: str, fmt: str = AUDIO_FORMAT, quality: str = TTS_QUALITY) -> str:
+    """Content address for synthesized audio: hash of text + every parameter that changes the output"""
+    if engine == "openai":
+        params = f"openai|{QUALITY_MODELS[quality]}|{TTS_VOICE}|{TTS_SPEED}|{lang}|{fmt}"
+    else:
+        params = f"{engine}|{lang.split('-')[0]}|{fmt}"
+    return hashlib.sha256(f"{params}\n{text}".encode("utf-8")).hexdigest()
+
+
+class AudioCache:
+    """Content-addressed audio files with single-flight synthesis per key"""
+
+    def __init__(self, store: AudioStore, segment_workers: int = 4):
+        self.store = store
+        # Missing sentences of one reply are synthesized in parallel
+        self._segment_pool = ThreadPoolExecutor(max_workers=segment_workers, thread_name_prefix="tts-phrase")
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0  # requests that waited on someone else's in-flight synthesis
+        self.failures = 0
+        self.streamed = 0  # misses relayed to a client while being synthesized
+        self.phrases = 0
+        self.phrase_hits = 0
+        self.cached_bytes = 0  # audio bytes of segmented replies that came from cache...
+        self.synth_bytes = 0  # ...and that had to be synthesized
+        self.stitched = 0
+        self.resynthesized = 0  # segmented replies synthesized whole because a sentence fell back
+
+    @staticmethod
+    def _fname(text: str, target_lang: str, fmt: str, quality: str) -> str:
+        return f"{audio_key(text, 'openai', target_lang, fmt, quality)}.{fmt}"
+
+    def get(self, text: str, target_lang: str, fmt: str = AUDIO_FORMAT, quality: str = TTS_QUALITY) -> Optional[str]:
+        """Filename of audio for text, synthesizing it only if no cached copy exists"""
+        return self.lookup(text, target_lang, fmt, quality)[0]
+
+    def lookup(self, text: str, target_lang: str, fmt: str, quality: str,
+               deadline: Deadline = None) -> Tuple[Optional[str], bool]:
+        """(filename or None, True if no new synthesis was needed for it); deadline caps the wait"""
+        fname = self._fname(text, target_lang, fmt, quality)
+        if self.store.exists(fname):
+            self.store.touch(fname)
+            self.hits += 1
+            return fname, True
+        with self._lock:
+            fut = self._inflight.get(fname)
+            owner = fut is None
+            if owner:
+                fut = self._inflight[fname] = Future()
+        if not owner:
+            self.joined += 1
+            try:
+                return fut.result(timeout=deadline.remaining() if deadline is not None else None), True
+            except FutureTimeout:
+                return None, True
+
+        self.misses += 1
+        try:
+            result = self._synthesize(text, target_lang, fname, fmt, quality, deadline)
+            fut.set_result(result)
+            return result, False
+        except Exception as e:
+            fut.set_result(None)
+            print("TTS cache error:", e)
+            return None, False
+        finally:
+            with self._lock:
+                self._inflight.pop(fname, None)
+
+    def _synthesize(self, text: str, target_lang: str, fname: str, fmt: str, quality: str,
+                    deadline: Deadline = None) -> Optional[str]:
+        tmp = self.store.tmp_path()
+        try:
+            produced = synthesize_to_file(text, target_lang, tmp, fmt, quality, deadline=deadline)
+            if produced is None:
+                self.failures += 1
+                return None
+            engine, written = produced
+            if engine != "openai":
+                # Fallback audio is cached under its own key, so the primary is retried next time
+                fname = f"{audio_key(text, engine, target_lang, written)}.{written}"
+            self.store.commit(tmp, fname)
+            return fname
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def get_segmented(self, text: str, target_lang: str, fmt: str = AUDIO_FORMAT,
+                      quality: str = TTS_QUALITY, deadline: Deadline = None) -> Optional[str]:
+        """Reply audio stitched from per-sentence phrase files; only uncached sentences are synthesized"""
+        sentences = split_sentences(text) or [text]
+        if len(sentences) > 1 and not joinable(fmt):
+            sentences = [text]  # e.g. opus without ffmpeg: synthesized whole instead of stitched
+        if len(sentences) == 1:
+            parts = [self.lookup(sentences[0], target_lang, fmt, quality, deadline)]
+        else:
+            parts = list(self._segment_pool.map(lambda s: self.lookup(s, target_lang, fmt, quality, deadline),
+                                                sentences))
+        self._count_phrases(parts)
+        if len(parts) == 1:
+            return parts[0][0]  # a fallback file in another format is served as it is
+        files = [fname for fname, _ in parts if fname and fname.endswith(f".{fmt}")]
+        if len(files) == len(parts):
+            stitched = self.stitch(files, fmt)
+            if stitched:
+                return stitched
+        # A sentence failed or came from a fallback tier in another format (or the parts couldn't
+        # be joined): rather than drop it from the reply, or byte-join (e.g. WAV) files that don't
+        # concatenate, synthesize the whole reply once through the tiers
+        self.resynthesized += 1
+        return self.lookup(text, target_lang, fmt, quality, deadline)[0]
+
+    def cached(self, text: str, target_lang: str, fmt: str = AUDIO_FORMAT, quality: str = TTS_QUALITY) -> Optional[str]:
+        """What get_segmented would return, if that is already on disk (never synthesizes or stitches)"""
+        sentences = split_sentences(text) or [text]
+        if len(sentences) > 1 and not joinable(fmt):
+            sentences = [text]
+        fnames = [self._fname(s, target_lang, fmt, quality) for s in sentences]
+        fname = fnames[0] if len(fnames) == 1 else self._stitched_name(fnames, fmt)
+        if not self.store.exists(fname):
+            return None
+        self.store.touch(fname)
+        self.hits += 1
+        return fname
+
+    def _count_phrases(self, parts: List[Tuple[Optional[str], bool]]):
+        for fname, cached in parts:
+            self.phrases += 1
+            if not fname:
+                continue
+            try:
+                size = os.path.getsize(self.store.path(fname))
+            except OSError:
+                continue
+            if cached:
+                self.phrase_hits += 1
+                self.cached_bytes += size
+            else:
+                self.synth_bytes += size
+
+    @staticmethod
+    def _stitched_name(fnames: List[str], fmt: str) -> str:
+        key = hashlib.sha256(("stitch\n" + "\n".join(fnames)).encode("utf-8")).hexdigest()
+        return f"{key}.{fmt}"
+
+    def stitch(self, fnames: List[str], fmt: str) -> Optional[str]:
+        """One file holding fnames back to back (itself content-addressed by its parts).
+
+        Concatenated byte for byte for CONCAT_FORMATS, remuxed with ffmpeg otherwise.
+        """
+        out = self._stitched_name(fnames, fmt)
+        if self.store.exists(out):
+            self.store.touch(out)
+            return out
+        tmp = self.store.tmp_path()
+        try:
+            if fmt in CONCAT_FORMATS:
+                with open(tmp, "wb") as dst:
+                    for fname in fnames:
+                        with open(self.store.path(fname), "rb") as src:
+                            shutil.copyfileobj(src, dst)
+            elif not _remux([self.store.path(fname) for fname in fnames], tmp, fmt):
+                return None
+            self.store.commit(tmp, out)
+            self.stitched += 1
+            return out
+        except OSError as e:
+            print("Audio stitch error:", e)
+            return None
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def stream(self, text: str, target_lang: str, fmt: str = AUDIO_FORMAT, quality: str = TTS_QUALITY,
+               chunk_size: int = 16 * 1024, join_timeout: Optional[float] = None) -> Iterator:
+        """Audio for text, relayed from OpenAI as it arrives and teed into the cache.
+
+        The first item is the format of the audio that follows (a fallback tier may have
+        written another one), or None if no audio could be produced; then come the bytes.
+        Cache hits (and requests that join an in-flight synthesis) are read from disk; a
+        join waits at most join_timeout for the owning request's client to finish.
+        """
+        fname = self._fname(text, target_lang, fmt, quality)
+        if self.store.exists(fname):
+            self.store.touch(fname)
+            self.hits += 1
+        else:
+            with self._lock:
+                fut = self._inflight.get(fname)
+                owner = fut is None
+                if owner:
+                    fut = self._inflight[fname] = Future()
+            if owner:
+                self.misses += 1
+                self.streamed += 1
+                yield from self._stream_and_tee(text, target_lang, fname, fut, fmt, quality, chunk_size)
+                return
+            self.joined += 1
+            try:
+                fname = fut.result(timeout=join_timeout)
+            except FutureTimeout:
+                fname = None
+        yield file_format(fname)
+        if fname:
+            yield from self._read(fname, chunk_size)
+
+    def _stream_and_tee(self, text: str, target_lang: str, fname: str, fut: Future,
+                        fmt: str, quality: str, chunk_size: int):
+        tmp = self.store.tmp_path()
+        result = None
+        breaker = tts_breakers["openai"]
+        try:
+            if breaker.allow():
+                blocks, first = stream_speech(text, chunk_size, fmt, quality), None
+                try:
+                    first = next(blocks, None)  # the format is only announced once OpenAI has answered
+                except Exception as e:
+                    print("OpenAI TTS stream error:", e)
+                if first is None:
+                    breaker.record_failure()
+                else:
+                    yield fmt
+                    try:
+                        with open(tmp, "wb") as f:
+                            f.write(first)
+                            yield first
+                            for block in blocks:
+                                f.write(block)
+                                yield block
+                        breaker.record_success()
+                        self.store.commit(tmp, fname)
+                        result = fname
+                    except Exception as e:
+                        breaker.record_failure()
+                        print("OpenAI TTS stream error:", e)
+                    return  # part of the audio already went out; don't append a second voice
+            produced = fallback_to_file(text, target_lang, tmp, fmt, quality)
+            if produced is None:
+                self.failures += 1
+                yield None
+                return
+            engine, written = produced
+            result = f"{audio_key(text, engine, target_lang, written)}.{written}"
+            self.store.commit(tmp, result)
+            yield written
+            yield from self._read(result, chunk_size)
+        finally:
+            # Also runs when the client disconnects: waiters get None and the partial file is dropped
+            fut.set_result(result)
+            with self._lock:
+                self._inflight.pop(fname, None)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _read(self, fname: str, chunk_size: int) -> Iterator[bytes]:
+        try:
+            f = open(self.store.path(fname), "rb")
+        except OSError:
+            return  # evicted in the meantime
+        with f:
+            while True:
+                block = f.read(chunk_size)
+                if not block:
+                    break
+                yield block
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.joined
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "joined_inflight": self.joined,
+            "failures": self.failures,
+            "streamed": self.streamed,
+            "inflight": len(self._inflight),
+            "hit_rate": round((self.hits + self.joined) / lookups, 4) if lookups else None,
+            "phrases": {
+                "sentences": self.phrases,
+                "hits": self.phrase_hits,
+                "stitched": self.stitched,
+                "resynthesized_whole": self.resynthesized,
+                "cached_audio_fraction": (round(self.cached_bytes / (self.cached_bytes + self.synth_bytes), 4)
+                                          if self.cached_bytes + self.synth_bytes else None),
+            },
+        }
+
+
+tts_cache = AudioCache(audio_store, segment_workers=int(os.getenv("TTS_SEGMENT_WORKERS", "4")))
+
+
+def render(text: str, target_lang: str, fmt: str = AUDIO_FORMAT, quality: str = TTS_QUALITY,
+           deadline: Deadline = None) -> Optional[str]:
+    """Cached TTS (per sentence, stitched): filename in audio_store, or None if synthesis failed
+    (or, given a deadline, did not finish within it)"""
+    return tts_cache.get_segmented(text, target_lang, fmt, quality, deadline)
@@ -0,0 +1,242 @@
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from typing import Callable, List, Optional
+
+from playlist_store import PlaylistStore
+
+# Sentence-pipelined TTS. A reply is split on sentence boundaries and every
+# sentence is queued on a bounded synthesis pool in order, so sentence 1 is
+# playable while sentence 2+ are still being synthesized. Each reply gets a
+# Playlist of ordered chunks that clients can fetch one by one or as one stream.
+# The same bounded pool also runs whole-reply synthesis (a one-chunk playlist), so
+# TTS bursts queue here instead of holding Flask workers. With a PlaylistStore the
+# chunk outcomes are also recorded in SQLite, so any worker process can serve a playlist.
+
+# A sentence ends at a run of terminators plus any closing quotes/brackets, followed by
+# whitespace or the end of the text (so "3.5" stays whole); a single period after a
+# common abbreviation, an initial or a dotted abbreviation ("Mr. Fredricksen", "J. R.",
+# "e.g.", "U.S.") doesn't end one.
+_BOUNDARY = re.compile(r"[.!?…]+[\"')\]]*(?=\s|$)")
+_LAST_WORD = re.compile(r"(\S+)$")
+_ABBREVIATION = re.compile(r"(?:[^\W\d_]\.)*[^\W\d_]")  # a dotted "e.g" / "U.S", or a single letter
+_ABBREVIATIONS = {
+    "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "mt", "vs", "etc", "approx", "no",
+    "sra", "srta", "dra", "ud", "uds", "mme", "mlle", "bzw", "usw", "ca",
+}
+
+
+def split_sentences(text: str) -> List[str]:
+    text = text.strip()
+    sentences, start = [], 0
+    for m in _BOUNDARY.finditer(text):
+        if m.group().rstrip("\"')]") == ".":
+            word = _LAST_WORD.search(text, start, m.start())
+            if word and (word.group(1).lower() in _ABBREVIATIONS or _ABBREVIATION.fullmatch(word.group(1))):
+                continue
+        sentences.append(text[start:m.end()])
+        start = m.end()
+    sentences.append(text[start:])
+    return [s.strip() for s in sentences if s.strip()]
+
+
+class Playlist:
+    def __init__(self, playlist_id: str, sentences: List[str], options: Optional[dict] = None):
+        self.id = playlist_id
+        self.sentences = sentences
+        self.options = options or {}  # extra render() arguments, e.g. audio format/quality
+        self.chunks: List[Future] = []  # each resolves to a filename (or None on failure)
+        self.created = time.time()
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def chunk(self, index: int, timeout: Optional[float] = None) -> Optional[str]:
+        return self.chunks[index].result(timeout=timeout)
+
+    def wait(self, timeout: Optional[float] = None):
+        wait(self.chunks, timeout=timeout)
+
+    def state(self) -> str:
+        """pending until every chunk is done; then ready (any audio) or failed"""
+        if not all(f.done() for f in self.chunks):
+            return "pending"
+        return "ready" if any(f.result() for f in self.chunks) else "failed"
+
+    def status(self) -> List[dict]:
+        out = []
+        for i, fut in enumerate(self.chunks):
+            if not fut.done():
+                state, fname = "pending", None
+            else:
+                fname = fut.result()
+                state = "ready" if fname else "failed"
+            out.append({"index": i, "text": self.sentences[i], "status": state, "file": fname})
+        return out
+
+
+class StoredPlaylist:
+    """A playlist synthesized by another worker process, polled from the shared PlaylistStore"""
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, store: PlaylistStore, row: dict, stale_after: float):
+        self.store = store
+        self.id = row["id"]
+        self.sentences = [c["text"] for c in row["chunks"]]
+        self.options = row["options"]
+        self.created = row["created"]
+        self.stale_after = stale_after  # a chunk pending this long is treated as failed (owner died)
+        self._chunks = row["chunks"]
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def _refresh(self):
+        row = self.store.load(self.id)
+        if row is not None:
+            self._chunks = row["chunks"]
+
+    def _chunk_status(self, index: int) -> str:
+        status = self._chunks[index]["status"]
+        if status == "pending" and time.time() - self.created > self.stale_after:
+            return "failed"
+        return status
+
+    def chunk(self, index: int, timeout: Optional[float] = None) -> Optional[str]:
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            status = self._chunk_status(index)
+            if status != "pending":
+                return self._chunks[index]["file"] if status == "ready" else None
+            if deadline is not None and time.time() >= deadline:
+                raise TimeoutError(f"chunk {index} of {self.id} not ready")
+            time.sleep(self.POLL_INTERVAL)
+            self._refresh()
+
+    def wait(self, timeout: Optional[float] = None):
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.state() == "pending" and (deadline is None or time.time() < deadline):
+            time.sleep(self.POLL_INTERVAL)
+            self._refresh()
+
+    def state(self) -> str:
+        statuses = [self._chunk_status(i) for i in range(len(self))]
+        if "pending" in statuses:
+            return "pending"
+        return "ready" if "ready" in statuses else "failed"
+
+    def status(self) -> List[dict]:
+        return [dict(c, status=self._chunk_status(c["index"])) for c in self._chunks]
+
+
+class TTSPipeline:
+    def __init__(self, render: Callable[[str, str], Optional[str]],
+                 max_workers: int = 4, max_playlists: int = 1000, max_pending: int = 500,
+                 store: Optional[PlaylistStore] = None, stale_after: float = 300.0,
+                 peek: Optional[Callable[[str, str], Optional[str]]] = None):
+        self.render = render  # (text, lang, **options) -> audio filename or None
+        self.peek = peek  # (text, lang, **options) -> filename render would return, if it is already cached
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts")
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._pending = 0
+        self.shed = 0
+        self.max_playlists = max_playlists
+        self.store = store
+        self.stale_after = stale_after
+        self._playlists: "OrderedDict[str, Playlist]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.sentences = 0
+        self.first_chunk_ms: List[float] = []
+
+    def start(self, text: str, target_lang: str, split: bool = True, **options) -> Playlist:
+        """Queue synthesis per sentence (or of the whole text with split=False)"""
+        sentences = (split_sentences(text) if split else []) or [text]
+        playlist = Playlist(uuid.uuid4().hex, sentences, options)
+        # Cached chunks are ready at once, without a round-trip through the pool (and are never shed)
+        cached = [self._peek(sentence, target_lang, options) for sentence in sentences]
+        misses = sum(1 for fname in cached if not fname)
+        with self._lock:
+            overloaded = self._pending + misses > self.max_pending
+            if not overloaded:
+                self._pending += misses
+        self._record(lambda: self.store.create(playlist.id, sentences, options,
+                                               "failed" if overloaded else "pending"))
+        if overloaded and misses:
+            self.shed += 1  # the reply still goes out, just without the uncached audio
+        started = time.time()
+        for i, sentence in enumerate(sentences):
+            if cached[i] or overloaded:
+                fut = Future()
+                fut.set_result(cached[i])
+            else:
+                fut = self.pool.submit(self._synthesize_chunk, sentence, target_lang,
+                                       started if i == 0 else None, options)
+                fut.add_done_callback(self._chunk_done)
+            fut.add_done_callback(lambda f, i=i: self._record(
+                lambda: self.store.finish(playlist.id, i, f.result() if f.exception() is None else None)))
+            playlist.chunks.append(fut)
+        if not overloaded:
+            self.sentences += len(sentences)
+        with self._lock:
+            self._playlists[playlist.id] = playlist
+            while len(self._playlists) > self.max_playlists:
+                self._playlists.popitem(last=False)
+        return playlist
+
+    def _record(self, write: Callable[[], None]):
+        """Mirror playlist state into the shared store; a store error never fails synthesis"""
+        if self.store is None:
+            return
+        try:
+            write()
+        except Exception as e:
+            print("Playlist store error:", e)
+
+    def _peek(self, sentence: str, target_lang: str, options: dict) -> Optional[str]:
+        if self.peek is None:
+            return None
+        try:
+            return self.peek(sentence, target_lang, **options)
+        except Exception as e:
+            print("TTS cache peek error:", e)
+            return None
+
+    def _chunk_done(self, _fut):
+        with self._lock:
+            self._pending -= 1
+
+    def _synthesize_chunk(self, sentence: str, target_lang: str, started: Optional[float], options: dict):
+        fname = self.render(sentence, target_lang, **options)
+        if started is not None:
+            self.first_chunk_ms = (self.first_chunk_ms + [(time.time() - started) * 1000])[-200:]
+        return fname
+
+    def get(self, playlist_id: str):
+        """This worker's Playlist, else a StoredPlaylist view of one started by another worker"""
+        with self._lock:
+            playlist = self._playlists.get(playlist_id)
+        if playlist is not None or self.store is None:
+            return playlist
+        try:
+            row = self.store.load(playlist_id)
+        except Exception as e:
+            print("Playlist store error:", e)
+            return None
+        return StoredPlaylist(self.store, row, self.stale_after) if row else None
+
+    def stats(self) -> dict:
+        samples = self.first_chunk_ms
+        return {
+            "workers": self.max_workers,
+            "pending_chunks": self._pending,
+            "max_pending": self.max_pending,
+            "shed": self.shed,
+            "playlists": len(self._playlists),
+            "sentences": self.sentences,
+            "avg_first_chunk_ms": round(sum(samples) / len(samples), 1) if samples else None,
+        }
@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from circuit_breaker import CircuitOpenError
+
+# Write-behind buffer for vector upserts. Callers enqueue and return immediately;
+# a flusher thread groups vectors by namespace and upserts them in batches once
+# batch_size vectors are pending or flush_interval has passed. Memory is bounded
+# by max_pending (in-flight batches included): when full, put() waits up to
+# put_timeout and then dead-letters the vector instead of growing. While the
+# upstream's circuit breaker is open, batches are dead-lettered at once rather
+# than backed off, so an outage doesn't stall the flusher and fill the buffer.
+
+
+class WriteBehindQueue:
+    def __init__(self, upsert: Callable[[str, List[dict]], None], batch_size: int = 100,
+                 flush_interval: float = 1.0, max_pending: int = 5000, put_timeout: float = 2.0,
+                 max_retries: int = 3, retry_backoff: float = 0.5, dead_letter_path: Optional[str] = None):
+        self.upsert = upsert
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.dead_letter_path = dead_letter_path
+
+        self._pending: Dict[str, List[dict]] = {}
+        self._count = 0  # queued + in-flight
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._dead_letter_lock = threading.Lock()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._worker.start()
+
+        self.enqueued = 0
+        self.flushed = 0
+        self.upsert_calls = 0
+        self.retries = 0
+        self.dead_lettered = 0
+        self.rejected = 0  # vectors dead-lettered because the breaker was open
+
+    def put(self, namespace: str, vector: dict) -> bool:
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._count < self.max_pending or self._closed,
+                                       timeout=self.put_timeout) or self._closed:
+                full = True
+            else:
+                full = False
+                self._pending.setdefault(namespace, []).append(vector)
+                self._count += 1
+                self._queued += 1
+                self.enqueued += 1
+                if self._queued >= self.batch_size:
+                    self._cond.notify_all()
+        if full:
+            self._dead_letter(namespace, [vector], "write-behind queue full")
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queued >= self.batch_size or self._closed,
+                                    timeout=self.flush_interval)
+                batch, self._pending = self._pending, {}
+                n, self._queued = self._queued, 0
+                closed = self._closed
+            for namespace, vectors in batch.items():
+                for i in range(0, len(vectors), self.batch_size):
+                    self._upsert_with_retry(namespace, vectors[i:i + self.batch_size])
+            if n:
+                with self._cond:
+                    self._count -= n
+                    self._cond.notify_all()
+            if closed and not n:
+                return
+
+    def _upsert_with_retry(self, namespace: str, vectors: List[dict]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.upsert_calls += 1
+                self.upsert(namespace, vectors)
+                self.flushed += len(vectors)
+                return
+            except CircuitOpenError as e:
+                error = e
+                self.rejected += len(vectors)
+                break  # every retry would be rejected as well; don't hold up the other namespaces
+            except Exception as e:
+                error = e
+                if attempt < self.max_retries:
+                    self.retries += 1
+                    time.sleep(self.retry_backoff * (2 ** attempt))
+        print(f"[WriteBehind] giving up on {len(vectors)} vectors for namespace {namespace}:", error)
+        self._dead_letter(namespace, vectors, str(error))
+
+    def _dead_letter(self, namespace: str, vectors: List[dict], reason: str):
+        self.dead_lettered += len(vectors)
+        if not self.dead_letter_path:
+            return
+        try:
+            with self._dead_letter_lock, open(self.dead_letter_path, "a") as f:
+                for v in vectors:
+                    f.write(json.dumps({"namespace": namespace, "vector": v, "error": reason, "ts": time.time()}) + "\n")
+        except Exception as e:
+            print("Dead-letter write error:", e)
+
+    def close(self, timeout: float = 10.0):
+        """Flush everything still buffered and stop the flusher"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._worker.join(timeout=timeout)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._count,
+            "max_pending": self.max_pending,
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "upsert_calls": self.upsert_calls,
+            "retries": self.retries,
+            "dead_lettered": self.dead_lettered,
+            "rejected_by_breaker": self.rejected,
+        }